@@ -0,0 +1,65 @@
+from typing import Optional
+
+from redis import asyncio as redis
+
+from .core.config import settings
+
+# Shared Redis client (None when REDIS_URL is not configured)
+redis_client: Optional[redis.Redis] = None
+
+
+async def init_redis() -> None:
+    """
+    Create the shared Redis client if REDIS_URL is configured.
+    """
+    global redis_client
+    if settings.REDIS_URL:
+        redis_client = redis.from_url(settings.REDIS_URL)
+
+
+async def close_redis() -> None:
+    """
+    Close the shared Redis client and its connection pool.
+    """
+    global redis_client
+    if redis_client is not None:
+        await redis_client.close()
+        redis_client = None
+
+
+async def get_cached(key: str) -> Optional[bytes]:
+    """
+    Get a cached value from Redis.
+
+    Args:
+        key: Cache key
+
+    Returns:
+        Cached bytes, or None on a miss, when Redis is disabled or unavailable
+    """
+    if redis_client is None:
+        return None
+
+    try:
+        return await redis_client.get(key)
+    except Exception as e:
+        print(f"Error reading cache key {key}: {e}")
+        return None
+
+
+async def set_cached(key: str, value: bytes, ttl: int) -> None:
+    """
+    Store a value in Redis with an expiry.
+
+    Args:
+        key: Cache key
+        value: Serialized value to store
+        ttl: Time to live in seconds
+    """
+    if redis_client is None:
+        return
+
+    try:
+        await redis_client.setex(key, ttl, value)
+    except Exception as e:
+        print(f"Error writing cache key {key}: {e}")
@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Union
 
 from pydantic import AnyHttpUrl, EmailStr, PostgresDsn, field_validator
@@ -13,9 +14,20 @@ class Settings(BaseSettings):
     API_V1_STR: str = "/api"
     SECRET_KEY: str
     ENVIRONMENT: str = "development"
+    LOG_LEVEL: str = "INFO"
     
     # Database settings
     DATABASE_URL: str
+    DB_POOL_SIZE: int = 20  # Connections kept open (and warmed on startup)
+    DB_MAX_OVERFLOW: int = 10  # Extra connections allowed during bursts
+    DB_POOL_TIMEOUT: int = 30  # Seconds to wait for a free connection
+    DB_POOL_RECYCLE: int = 3600  # Seconds before a connection is replaced
+    DB_USE_PGBOUNCER: bool = False  # Disable prepared statement caches for PgBouncer transaction mode
+    CREATE_TABLES_ON_STARTUP: bool = True  # Disable once the schema exists to skip catalog checks
+    
+    # Cache settings
+    REDIS_URL: Optional[str] = None  # Caching is disabled when not set
+    LEADERBOARD_CACHE_TTL_SECONDS: int = 30
     
     # CORS settings for frontend
     FRONTEND_URL: str
@@ -33,6 +45,8 @@ class Settings(BaseSettings):
     STRAVA_CLIENT_ID: str
     STRAVA_CLIENT_SECRET: str
     STRAVA_WEBHOOK_VERIFY_TOKEN: str = "kmtb_strava_webhook_verify_token"  # Default value, should be changed in production
+    STRAVA_MAX_RETRIES: int = 3  # Retries when Strava answers 429 Too Many Requests
+    STRAVA_RETRY_BACKOFF_SECONDS: float = 1.0  # Doubled after each rate-limited attempt
     
     # Email settings
     SMTP_SERVER: str
@@ -40,6 +54,12 @@ class Settings(BaseSettings):
     SMTP_USERNAME: str
     SMTP_FROM: str
     SMTP_PASSWORD: str
+    SMTP_POOL_SIZE: int = 4  # Idle SMTP connections kept open for reuse
+    EMAIL_WORKERS: int = 4  # Threads sending emails in parallel
+    SMTP_RATE_PER_SEC: float = 10.0  # Sustained send rate allowed by the SMTP provider
+    SMTP_BURST: int = 10  # Emails that may be sent back-to-back before throttling
+    EMAIL_MAX_RETRIES: int = 5  # Retries for transient SMTP failures
+    EMAIL_RETRY_BACKOFF_SECONDS: int = 2  # Doubled after each failed attempt
     
     # Token settings
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30  # 30 minutes
@@ -50,8 +70,10 @@ class Settings(BaseSettings):
     
     # GPX verification settings
     ROUTE_SIMILARITY_THRESHOLD: float = 0.8  # 80% similarity required for verification
+    VERIFY_SHORTCIRCUIT_THRESHOLD: float = 0.95  # Stop comparing other routes once a match is this close
     GPS_MAX_DEVIATION_METERS: float = 20.0   # 20 meters max deviation
     MIN_ACTIVITY_DISTANCE_KM: float = 100.0  # 100 kilometers minimum required
+    GPS_FULL_REPORT: bool = False  # Compare every activity point even once the verdict is known (for debugging)
 
     # Model config
     model_config = {
@@ -60,5 +82,14 @@ class Settings(BaseSettings):
     }
 
 
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    Get the cached application settings.
+    Can also be used as a FastAPI dependency and overridden in tests.
+    """
+    return Settings()
+
+
 # Create global settings object
-settings = Settings()
\ No newline at end of file
+settings = get_settings()
\ No newline at end of file
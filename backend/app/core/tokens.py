@@ -0,0 +1,36 @@
+import base64
+import binascii
+import secrets
+from typing import Optional
+
+# Raw token size in bytes, as stored in the database
+TOKEN_BYTES = 32
+
+
+def generate_token() -> bytes:
+    """
+    Generate the raw bytes of a one-time token
+    """
+    return secrets.token_bytes(TOKEN_BYTES)
+
+
+def encode_token(raw: bytes) -> str:
+    """
+    Encode raw token bytes as unpadded URL-safe base64
+    """
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def decode_token(token: str) -> Optional[bytes]:
+    """
+    Decode a token from a link back to its raw bytes
+
+    Returns:
+        Raw token bytes, or None if the token is malformed (None matches no stored token)
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        return None
+
+    return raw if len(raw) == TOKEN_BYTES else None
@@ -1,28 +1,79 @@
-from typing import Generator
+import asyncio
+import logging
+from functools import wraps
+from typing import AsyncGenerator, Callable, Optional
 
-from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
 from .core.config import settings
 
-# Create SQLAlchemy engine with PostgreSQL connection string
-engine = create_engine(settings.DATABASE_URL)
+logger = logging.getLogger("database")
+
+# Use the asyncpg driver regardless of the scheme given in DATABASE_URL
+ASYNC_DATABASE_URL = settings.DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+# PgBouncer in transaction mode can't keep prepared statements between transactions
+connect_args = {}
+if settings.DB_USE_PGBOUNCER:
+    connect_args = {"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+
+# Create pooled async SQLAlchemy engine
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+    connect_args=connect_args,
+)
 
 # Create a session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 
 # Base class for declarative models
 Base = declarative_base()
 
 
-def get_db() -> Generator:
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
     """
     Dependency for FastAPI endpoints to get a database session.
-    Yields a database session and ensures it's closed after use.
+    Yields an async database session and ensures it's closed after use.
     """
-    db = SessionLocal()
-    try:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+
+def retry_on_integrity_error(
+    max_attempts: int = 3,
+    backoff: float = 0.05,
+    should_retry: Optional[Callable[[IntegrityError], bool]] = None,
+):
+    """
+    Retry an async function that lost a concurrent insert race.
+    The decorated function must take the session as its first argument;
+    it is rolled back before every retry and before the final error is raised.
+    
+    Args:
+        max_attempts: Total number of attempts
+        backoff: Delay before the first retry in seconds, doubled after each attempt
+        should_retry: Optional check returning False for errors that must not be retried
+    """
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(db: AsyncSession, *args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return await fn(db, *args, **kwargs)
+                except IntegrityError as e:
+                    await db.rollback()
+                    if attempt == max_attempts - 1 or (should_retry and not should_retry(e)):
+                        raise
+                    logger.warning(
+                        "Retrying %s after integrity error (attempt %d/%d)", fn.__name__, attempt + 1, max_attempts
+                    )
+                    await asyncio.sleep(backoff * 2 ** attempt)
+        return wrapper
+    return decorator
@@ -1,28 +1,72 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import text
 
+from .cache import close_redis, init_redis
 from .core.config import settings
-from .database import SessionLocal, engine, Base
+from .database import SessionLocal, engine
+from .middleware.profiling_middleware import add_profiling_middleware
 from .routers import activities, auth, strava, users
+from .schema import upgrade_schema
+from .services.email_service import shutdown_email_executor
 from .services.source_gpx_service import init_source_gpx_database
+from .services.strava_service import close_http_client
+
+# Configure logging once for the whole process
+logging.basicConfig(level=settings.LOG_LEVEL)
+
+
+async def warm_connection_pool() -> None:
+    """Open DB_POOL_SIZE connections in parallel and return them to the pool"""
+    async def warm():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*[warm() for _ in range(settings.DB_POOL_SIZE)])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialize the application on startup and release resources on shutdown"""
+    # Create and upgrade database tables (skipped when the schema is managed outside the app)
+    if settings.CREATE_TABLES_ON_STARTUP:
+        async with engine.begin() as conn:
+            await conn.run_sync(upgrade_schema)
+
+    # Initialize source GPX database
+    async with SessionLocal() as db:
+        await init_source_gpx_database(db)
+
+    # Warm the connection pool so the first requests don't pay the connect cost
+    await warm_connection_pool()
+
+    # Connect the shared Redis client
+    await init_redis()
+
+    yield
+
+    # Close Redis, the Strava HTTP client and all pooled connections
+    await close_redis()
+    await close_http_client()
+    await engine.dispose()
+
+    # Let queued emails finish sending
+    shutdown_email_executor()
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
-# Initialize source GPX database on startup
-@app.on_event("startup")
-async def startup_event():
-    """Initialize the application on startup"""
-    # Create a database session
-    db = SessionLocal()
-    # Initialize source GPX database
-    await init_source_gpx_database(db)
-
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -32,6 +76,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger JSON responses (activity lists, leaderboards)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Allow profiling individual requests with ?profile=1 outside production
+if settings.ENVIRONMENT != "production":
+    add_profiling_middleware(app)
+
 # Include routers
 app.include_router(auth.router, prefix=f"{settings.API_V1_STR}", tags=["auth"])
 app.include_router(users.router, prefix=f"{settings.API_V1_STR}", tags=["users"])
@@ -1,78 +1,82 @@
+import re
 import time
 import json
-from typing import Callable, Dict, Any
-from fastapi import Request, Response
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.types import ASGIApp
+from typing import List, Optional
+from urllib.parse import parse_qsl
 
-class DebugMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app: ASGIApp, debug_paths: list = None):
-        super().__init__(app)
-        self.debug_paths = debug_paths or ["/api/strava/auth"]
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+class DebugMiddleware:
+    def __init__(self, app: ASGIApp, debug_paths: Optional[List[str]] = None):
+        self.app = app
+        self.debug_paths = tuple(debug_paths or ["/api/strava/auth"])
+        # Match any of the debug paths anywhere in the request path
+        self._matcher = re.compile("|".join(re.escape(p) for p in self.debug_paths)).search
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # Only debug HTTP requests for the configured paths
+        if scope["type"] != "http" or not self._matcher(scope["path"]):
+            return await self.app(scope, receive, send)
 
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        # Check if this is a path we want to debug
-        should_debug = False
-        for path in self.debug_paths:
-            if path in request.url.path:
-                should_debug = True
-                break
-        
-        if not should_debug:
-            return await call_next(request)
-        
         # For debug paths, collect request details
         request_time = time.time()
-        request_body = None
-        
-        # Only try to read the body for POST/PUT requests
-        if request.method in ["POST", "PUT", "PATCH"]:
-            try:
-                request_body = await request.body()
-                await request.body()  # Reset request body
-            except Exception as e:
-                request_body = f"Error reading body: {str(e)}"
-        
+        method = scope["method"]
+
         # Get query parameters
-        query_params = dict(request.query_params)
-        
+        query_string = scope.get("query_string", b"").decode("latin-1")
+        query_params = dict(parse_qsl(query_string, keep_blank_values=True))
+        url = scope["path"] + (f"?{query_string}" if query_string else "")
+
         # Log request info
         print("\n" + "="*50)
-        print(f"DEBUG REQUEST: {request.method} {request.url}")
+        print(f"DEBUG REQUEST: {method} {url}")
         print(f"Query params: {json.dumps(query_params, indent=2)}")
-        if request_body:
-            print(f"Request body: {request_body.decode() if isinstance(request_body, bytes) else request_body}")
         print("="*50)
-        
+
+        # Only log the body for POST/PUT requests, teeing it as the app reads it
+        request_body = bytearray()
+        log_body = method in ["POST", "PUT", "PATCH"]
+
+        async def receive_wrapper() -> Message:
+            message = await receive()
+            if log_body and message["type"] == "http.request":
+                request_body.extend(message.get("body", b""))
+                if not message.get("more_body", False) and request_body:
+                    print(f"Request body: {request_body.decode(errors='replace')}")
+            return message
+
+        status_code = 500
+        response_body = bytearray()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                response_time = time.time() - request_time
+
+                # Log response info
+                print(f"\nDEBUG RESPONSE: Status {status_code} ({response_time:.2f}s)")
+            elif message["type"] == "http.response.body" and status_code >= 400:
+                # For error responses, collect the response body
+                response_body.extend(message.get("body", b""))
+                if not message.get("more_body", False):
+                    print(f"Response body: {response_body.decode(errors='replace')}")
+
+            await send(message)
+
         # Process the request
         try:
-            response = await call_next(request)
-            response_time = time.time() - request_time
-            
-            # Log response info
-            print(f"\nDEBUG RESPONSE: Status {response.status_code} ({response_time:.2f}s)")
-            
-            # For error responses, try to read the response body
-            if response.status_code >= 400:
-                response_body = []
-                async for chunk in response.body_iterator:
-                    response_body.append(chunk)
-                
-                # Combine the response chunks
-                response.body = b"".join(response_body)
-                print(f"Response body: {response.body.decode()}")
-            
+            await self.app(scope, receive_wrapper, send_wrapper)
             print("="*50 + "\n")
-            return response
         except Exception as e:
             # Log exceptions
             print(f"\nDEBUG EXCEPTION: {str(e)}")
             print("="*50 + "\n")
             raise
-            
+
 # Function to add the middleware to your app
 def add_debug_middleware(app):
     app.add_middleware(
-        DebugMiddleware, 
+        DebugMiddleware,
         debug_paths=["/api/strava/auth"]
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,37 @@
+from urllib.parse import parse_qs
+
+from pyinstrument import Profiler
+from starlette.responses import HTMLResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+class ProfilingMiddleware:
+    """Profile a request with pyinstrument when it is called with ?profile=1"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or b"profile" not in scope.get("query_string", b""):
+            return await self.app(scope, receive, send)
+
+        query_params = parse_qs(scope["query_string"].decode("latin-1"))
+        if query_params.get("profile", [""])[0] not in ("1", "true"):
+            return await self.app(scope, receive, send)
+
+        async def discard(message: Message) -> None:
+            # The profiler report replaces the endpoint response
+            pass
+
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            profiler.stop()
+
+        response = HTMLResponse(profiler.output_html())
+        await response(scope, receive, send)
+
+# Function to add the middleware to your app
+def add_profiling_middleware(app):
+    app.add_middleware(ProfilingMiddleware)
@@ -3,8 +3,8 @@ from datetime import datetime
 from typing import List, Optional
 
 from sqlalchemy import (
-    Boolean, Column, DateTime, Float, ForeignKey, Integer, 
-    String, Text, UniqueConstraint, func
+    Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, 
+    LargeBinary, String, Text, UniqueConstraint, func
 )
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
@@ -25,6 +25,8 @@ class User(Base):
     # Strava information
     strava_id = Column(String, unique=True, index=True, nullable=True)
     strava_username = Column(String, nullable=True)
+    strava_ride_count = Column(Integer, nullable=True)  # Strava's ride total at the last activity check
+    strava_activities_etag = Column(String, nullable=True)  # ETag of the activity list at the last activity check
     
     # Status flags
     is_active = Column(Boolean, default=True)
@@ -70,6 +72,12 @@ class Activity(Base):
     user = relationship("User", back_populates="activities")
     source_gpx = relationship("SourceGPX", back_populates="activities")
     
+    # Indexes
+    __table_args__ = (
+        # Per-user activity list ordered by newest first
+        Index("ix_activity_user_startdate", user_id, start_date.desc()),
+    )
+    
     def __repr__(self):
         return f"<Activity {self.name} - {self.start_date}>"
 
@@ -134,7 +142,7 @@ class SourceGPX(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name = Column(String, nullable=False)
     description = Column(Text, nullable=True)
-    filename = Column(String, nullable=False)
+    filename = Column(String, unique=True, index=True, nullable=False)
     distance = Column(Float, nullable=False)  # in meters
     
     # Status flags
@@ -158,7 +166,7 @@ class VerificationToken(Base):
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
-    token = Column(String, unique=True, index=True, nullable=False)
+    token = Column(LargeBinary(32), unique=True, index=True, nullable=False)  # Raw bytes, base64 in links
     type = Column(String, nullable=False)  # 'email', 'strava', 'delete'
     used = Column(Boolean, default=False)
     expires_at = Column(DateTime, nullable=False)
@@ -169,6 +177,18 @@ class VerificationToken(Base):
     # Relationships
     user = relationship("User")
     
+    # Indexes
+    __table_args__ = (
+        # Covers the unused-token lookup with user_id and token, filtering the rest from the index
+        Index(
+            "ix_verification_lookup",
+            user_id,
+            token,
+            postgresql_include=["type", "used", "expires_at"],
+            postgresql_where=(used == False),
+        ),
+    )
+    
     def __repr__(self):
         return f"<VerificationToken {self.type} for user_id {self.user_id}>"
 
@@ -202,5 +222,11 @@ class Leaderboard(Base):
     activity_count = Column(Integer, default=0)
     last_updated = Column(DateTime, default=func.now())
     
+    # Indexes
+    __table_args__ = (
+        # Top-N leaderboard scan ordered by activity count
+        Index("ix_leaderboard_count_desc", activity_count.desc()),
+    )
+    
     def __repr__(self):
         return f"<Leaderboard {self.first_name} {self.last_name} - {self.activity_count} activities>"
\ No newline at end of file
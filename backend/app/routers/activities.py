@@ -1,9 +1,14 @@
-from typing import Dict, List
+import uuid
 
-from fastapi import APIRouter, Depends, HTTPException, Query, status
-from sqlalchemy.orm import Session
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .. import models
+from ..cache import get_cached, set_cached
+from ..core.config import settings
 from ..database import get_db
 from ..services.source_gpx_service import get_all_source_gpxs
 
@@ -11,73 +16,55 @@ from ..services.source_gpx_service import get_all_source_gpxs
 router = APIRouter()
 
 
-@router.get("/activities/leaderboard", response_model=List[Dict])
+@router.get("/activities/leaderboard")
 async def get_leaderboard(
     limit: int = Query(20, ge=1, le=100),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Get leaderboard with top users by activity count
     """
+    # Serve from cache when available - the leaderboard only changes when the worker runs
+    cache_key = f"lb:{limit}"
+    cached = await get_cached(cache_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+    
     # Join with users table to verify that users are active
-    leaderboard_entries = (
-        db.query(models.Leaderboard.first_name, models.Leaderboard.last_name, models.Leaderboard.activity_count) # Select only needed columns
+    result = await db.execute(
+        select(
+            models.Leaderboard.first_name,
+            # Get first letter and add dot
+            func.concat(func.upper(func.substr(models.Leaderboard.last_name, 1, 1)), ".").label("last_name"),
+            models.Leaderboard.activity_count,
+        ) # Select only needed columns
         .join(models.User, models.User.id == models.Leaderboard.id)
         .filter(models.User.is_active == True)
         .filter(models.Leaderboard.activity_count > 0) # Added filter for activity_count > 0
         .order_by(models.Leaderboard.activity_count.desc())
         .limit(limit)
-        .all()
     )
 
-    return [
-        {
-            "first_name": first_name,
-            "last_name": last_name[0].upper() + ".",  # Get first letter and add dot
-            "activity_count": activity_count
-        }
-        for first_name, last_name, activity_count in leaderboard_entries
-    ]
-
-
-@router.get("/activities/leaderboard", response_model=List[Dict])
-async def get_leaderboard(
-    limit: int = Query(20, ge=1, le=100),
-    db: Session = Depends(get_db)
-):
-    """
-    Get leaderboard with top users by activity count
-    """
-    # Join with users table to verify that users are active
-    leaderboard_entries = (
-        db.query(models.Leaderboard)
-        .join(models.User, models.User.id == models.Leaderboard.id)
-        .filter(models.User.is_active == True)
-        .order_by(models.Leaderboard.activity_count.desc())
-        .limit(limit)
-        .all()
-    )
+    leaderboard = [dict(row._mapping) for row in result]
+    
+    await set_cached(cache_key, orjson.dumps(leaderboard), settings.LEADERBOARD_CACHE_TTL_SECONDS)
     
-    return [
-        {
-            "first_name": entry.first_name,
-            "last_name": entry.last_name,
-            "activity_count": entry.activity_count
-        }
-        for entry in leaderboard_entries
-    ]
+    return leaderboard
 
 
-@router.get("/activities/user/{user_id}", response_model=List[Dict])
-async def get_user_activities(user_id: str, db: Session = Depends(get_db)):
+@router.get("/activities/user/{user_id}")
+async def get_user_activities(user_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
     """
     Get all verified activities for a user
     """
     # Check if user exists and is active
-    user = db.query(models.User).filter(
-        models.User.id == user_id,
-        models.User.is_active == True
-    ).first()
+    result = await db.execute(
+        select(models.User).filter(
+            models.User.id == user_id,
+            models.User.is_active == True
+        )
+    )
+    user = result.scalars().first()
     
     if not user:
         raise HTTPException(
@@ -85,29 +72,30 @@ async def get_user_activities(user_id: str, db: Session = Depends(get_db)):
             detail="User not found or inactive"
         )
     
-    # Get user's verified activities
-    activities = (
-        db.query(models.Activity)
+    # Get user's verified activities together with their source GPX name
+    stmt = (
+        select(models.Activity, models.SourceGPX.name)
+        .outerjoin(models.SourceGPX, models.SourceGPX.id == models.Activity.source_gpx_id)
         .filter(models.Activity.user_id == user_id)
         .order_by(models.Activity.start_date.desc())
-        .all()
+        .execution_options(yield_per=200)
     )
     
-    # Get source GPX info for each activity
-    result = []
-    for activity in activities:
-        source_gpx = db.query(models.SourceGPX).filter(
-            models.SourceGPX.id == activity.source_gpx_id
-        ).first()
-        
-        result.append({
-            "id": activity.id,
-            "name": activity.name,
-            "start_date": activity.start_date.isoformat(),
-            "distance_km": round(activity.distance / 1000, 1),
-            "duration_seconds": activity.duration,
-            "route_name": source_gpx.name if source_gpx else "Unknown route",
-            "verified_at": activity.verified_at.isoformat()
-        })
+    async def generate_activities():
+        # Stream rows from a server-side cursor and frame them as a JSON array
+        result = await db.stream(stmt)
+        separator = b"["
+        async for activity, route_name in result:
+            yield separator + orjson.dumps({
+                "id": str(activity.id),
+                "name": activity.name,
+                "start_date": activity.start_date.isoformat(),
+                "distance_km": round(activity.distance / 1000, 1),
+                "duration_seconds": activity.duration,
+                "route_name": route_name or "Unknown route",
+                "verified_at": activity.verified_at.isoformat()
+            })
+            separator = b","
+        yield b"[]" if separator == b"[" else b"]"
     
-    return result
\ No newline at end of file
+    return StreamingResponse(generate_activities(), media_type="application/json")
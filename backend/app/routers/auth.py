@@ -1,19 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..database import get_db
 from ..core.config import settings
 
 router = APIRouter()
 
+# Public settings only change on redeploy, so serialize them once at import time
+_PUBLIC_SETTINGS_BYTES = orjson.dumps({
+    "project_name": settings.PROJECT_NAME,
+    "strava_client_id": settings.STRAVA_CLIENT_ID,
+    "min_activity_distance_km": settings.MIN_ACTIVITY_DISTANCE_KM,
+})
+
 
 @router.get("/auth/settings")
 def get_public_settings():
     """
     Get public application settings for the frontend
     """
-    return {
-        "project_name": settings.PROJECT_NAME,
-        "strava_client_id": settings.STRAVA_CLIENT_ID,
-        "min_activity_distance_km": settings.MIN_ACTIVITY_DISTANCE_KM,
-    }
\ No newline at end of file
+    return Response(
+        content=_PUBLIC_SETTINGS_BYTES,
+        media_type="application/json",
+        headers={"Cache-Control": "public, max-age=300, stale-while-revalidate=60"},
+    )
\ No newline at end of file
@@ -1,289 +1,338 @@
 # Fully fixed version of backend/app/routers/strava.py
 
+import hashlib
 import logging
-import traceback
-from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import quote
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, status
-from sqlalchemy.orm import Session
+from cachetools import TTLCache
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Response, status
+from sqlalchemy import func, inspect, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 
 from .. import models
-from ..database import get_db
+from ..database import get_db, retry_on_integrity_error
 from ..core.config import settings
-from ..services.email_service import send_strava_connected_email
+from ..core.tokens import decode_token
+from ..services.email_service import enqueue_email, send_strava_connected_email
 from ..services.strava_service import (
     exchange_authorization_code, 
     get_strava_athlete_data
 )
 
-# Configure debug logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("strava_auth")
 
 router = APIRouter()
 
+# Query parameters of the Strava authorization URL that never change
+_AUTH_STATIC_PARAMS = (
+    f"client_id={settings.STRAVA_CLIENT_ID}"
+    f"&response_type=code"
+    f"&approval_prompt=force"
+    f"&scope={quote('activity:read,profile:read_all')}"
+)
 
-@router.get("/strava/auth/{user_id}/{token}")
-async def strava_auth(
+# Short-lived cache of verified (token, user) pairs for repeated initial auth requests.
+# Only the read-only initial request uses it; the code exchange always checks the database.
+_verification_cache = TTLCache(maxsize=10000, ttl=30)
+
+
+def _verification_cache_key(user_id: str, token: str) -> str:
+    """Build a cache key without keeping raw tokens in memory"""
+    return hashlib.sha256(f"{user_id}:{token}".encode()).hexdigest()[:32]
+
+
+async def _get_verification(
+    db: AsyncSession,
     user_id: str,
-    token: str,
+    token: str
+) -> Tuple[models.VerificationToken, models.User]:
+    """
+    Get a valid Strava verification token and its user
+    
+    Raises:
+        HTTPException: 404 if the token is invalid or expired
+    """
+    logger.debug("Verifying token: %s", token[:5])
+    # Fetch the token and its user in a single round-trip
+    result = await db.execute(
+        select(models.VerificationToken, models.User)
+        .join(models.User, models.VerificationToken.user_id == models.User.id)
+        .filter(
+            models.VerificationToken.user_id == user_id,
+            models.VerificationToken.token == decode_token(token),
+            models.VerificationToken.type == "strava",
+            models.VerificationToken.used == False,
+            models.VerificationToken.expires_at > func.now()
+        )
+    )
+    row = result.first()
+    
+    if not row:
+        logger.warning("Invalid or expired Strava authentication token: %s", token[:5])
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Invalid or expired Strava authentication token",
+        )
+    
+    verification, user = row
+    return verification, user
+
+
+def _is_duplicate_strava_id(e: IntegrityError) -> bool:
+    """Check whether an integrity error comes from another user already holding the Strava ID"""
+    error_text = str(e)
+    return "ix_users_strava_id" in error_text and "duplicate key value" in error_text
+
+
+@retry_on_integrity_error(should_retry=lambda e: not _is_duplicate_strava_id(e))
+async def _save_strava_connection(
+    db: AsyncSession,
     request: Request,
-    db: Session = Depends(get_db),
-    code: Optional[str] = None,
-    platform: Optional[str] = None,
+    user_id: str,
+    token: str,
+    token_response: Dict[str, Any],
+    verification: models.VerificationToken,
+    user: models.User
+) -> models.User:
+    """
+    Save the Strava token and connect the user in a single transaction
+    
+    Raises:
+        IntegrityError: If the Strava account is already connected to another user
+    """
+    athlete = token_response.get("athlete", {})
+    
+    # A retried attempt runs after a rollback, which expires the loaded rows
+    if inspect(verification).expired:
+        verification, user = await _get_verification(db, user_id, token)
+    
+    # Save token to database, replacing any previous token in the same statement
+    logger.debug("Saving token to database for user: %s", user_id)
+    token_values = {
+        "access_token": token_response["access_token"],
+        "refresh_token": token_response["refresh_token"],
+        "token_type": token_response["token_type"],
+        "expires_at": token_response["expires_at"],
+    }
+    await db.execute(
+        pg_insert(models.Token)
+        .values(user_id=user_id, **token_values)
+        .on_conflict_do_update(
+            index_elements=[models.Token.user_id],
+            set_={**token_values, "updated_at": func.now()}
+        )
+    )
+    
+    # Update user with Strava information
+    logger.debug("Updating user with Strava information: ID %s", athlete.get("id", ""))
+    user.strava_id = str(athlete.get("id", ""))
+    user.strava_username = athlete.get("username", "")
+    user.is_strava_connected = True
+    
+    # Mark verification token as used
+    logger.debug("Marking verification token as used")
+    verification.used = True
+    
+    # Log the event
+    logger.debug("Creating audit log entry")
+    audit_log = models.AuditLog(
+        user_id=user_id,
+        event_type="strava_connected",
+        description=f"User {user.email} connected Strava account",
+        ip_address=request.client.host if request.client else None,
+        user_agent=request.headers.get("user-agent"),
+    )
+    db.add(audit_log)
+    
+    # Create initial leaderboard entry
+    logger.debug("Creating or updating leaderboard entry for user: %s", user_id)
+    await db.execute(
+        pg_insert(models.Leaderboard)
+        .values(
+            id=user_id,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            activity_count=0,
+            last_updated=func.now()
+        )
+        .on_conflict_do_nothing(index_elements=[models.Leaderboard.id])
+    )
+    
+    # Commit all changes
+    logger.debug("Committing database changes")
+    await db.commit()
+    return user
+
+
+async def _handle_initial(
+    db: AsyncSession,
+    user_id: str,
+    token: str,
+    response: Response,
+    platform: Optional[str]
 ) -> Dict[str, Any]:
     """
-    Handle Strava OAuth callback with authorization code
+    Handle the initial request without a code by returning the Strava authorization URL
+    """
+    # Verify the token is valid (unless it was verified moments ago)
+    logger.debug("No code provided, verifying token")
+    cache_key = _verification_cache_key(user_id, token)
+    if cache_key not in _verification_cache:
+        verification, user = await _get_verification(db, user_id, token)
+        _verification_cache[cache_key] = (verification.id, user.id)
     
-    The platform parameter can be used to detect mobile devices:
-    - ios: iOS devices
-    - android: Android devices
-    - web: Desktop browsers (default)
+    logger.debug("Generating Strava auth URL for platform: %s", platform)
+    # Generate Strava authorization URL - use mobile endpoints if on mobile
+    redirect_uri = f"{settings.FRONTEND_URL}/strava-auth/{user_id}/{token}?frontend_redirect=true"
+    
+    # Determine if we should use the mobile OAuth endpoint
+    auth_base_url = "https://www.strava.com/oauth/authorize"
+    if platform in ['ios', 'android']:
+        auth_base_url = "https://www.strava.com/oauth/mobile/authorize"
+    
+    auth_url = f"{auth_base_url}?{_AUTH_STATIC_PARAMS}&redirect_uri={quote(redirect_uri, safe='')}"
+    
+    # The URL only depends on the path and platform, so let the browser reuse it
+    response.headers["Cache-Control"] = "private, max-age=60"
+    logger.debug("Returning auth URL: %.60s...", auth_url)
+    return {"auth_url": auth_url}
+
+
+async def _handle_callback(
+    db: AsyncSession,
+    user_id: str,
+    token: str,
+    request: Request,
+    code: str
+) -> Dict[str, Any]:
+    """
+    Handle the Strava callback by exchanging the code for tokens and connecting the user
     """
-    # Initialize variables to avoid scope issues
-    athlete = {}
-    token_response = {}
+    # Verify the token and get the user
+    verification, user = await _get_verification(db, user_id, token)
+    
+    # Exchange authorization code for tokens
+    logger.debug("Exchanging authorization code for tokens")
+    redirect_uri = f"{settings.FRONTEND_URL}/strava-auth/{user_id}/{token}?frontend_redirect=true"
+    token_response = await exchange_authorization_code(code, redirect_uri)
+    
+    # Log the token response (be careful not to log sensitive data in production)
+    if token_response:
+        logger.debug("Token response received with keys: %s", list(token_response))
+        if "errors" in token_response:
+            logger.error("Strava API errors: %s", token_response["errors"])
+        if "error" in token_response:
+            logger.error("Strava API error: %s", token_response["error"])
+    else:
+        logger.error("No token response received from Strava")
+    
+    if not token_response or "error" in token_response or "errors" in token_response:
+        error_msg = token_response.get("error", "Unknown error") if token_response else "Failed to get token"
+        logger.error("Failed to connect to Strava: %s", error_msg)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to connect to Strava: {error_msg}",
+        )
     
-    # Add detailed logging
-    logger.info(f"Strava auth called with user_id: {user_id}, token: {token[:5] if token else ''}, code: {code[:10] if code else 'None'}")
-    logger.info(f"Query parameters: {dict(request.query_params)}")
+    # Get athlete data
+    logger.debug("Getting athlete data from token response")
+    athlete = token_response.get("athlete", {})
     
     try:
-        # Check if we have the authorization code from Strava
-        if not code:
-            # No code provided, this is the initial request
-            # Verify the token is valid
-            logger.debug("No code provided, verifying token")
-            verification = (
-                db.query(models.VerificationToken)
-                .filter(
-                    models.VerificationToken.user_id == user_id,
-                    models.VerificationToken.token == token,
-                    models.VerificationToken.type == "strava",
-                    models.VerificationToken.used == False,
-                    models.VerificationToken.expires_at > datetime.now()
-                )
-                .first()
-            )
-            
-            if not verification:
-                logger.warning(f"Invalid or expired Strava authentication token: {token[:5] if token else ''}")
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="Invalid or expired Strava authentication token",
-                )
-            
-            # Get user
-            logger.debug(f"Getting user {user_id}")
-            user = db.query(models.User).filter(models.User.id == user_id).first()
-            if not user:
-                logger.warning(f"User not found: {user_id}")
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="User not found",
-                )
-            
-            logger.debug(f"Generating Strava auth URL for platform: {platform}")
-            # Generate Strava authorization URL - use mobile endpoints if on mobile
-            redirect_uri = f"{settings.FRONTEND_URL}/strava-auth/{user_id}/{token}?frontend_redirect=true"
-            
-            # Determine if we should use the mobile OAuth endpoint
-            auth_base_url = "https://www.strava.com/oauth/authorize"
-            if platform in ['ios', 'android']:
-                auth_base_url = "https://www.strava.com/oauth/mobile/authorize"
-            
-            auth_url = (
-                f"{auth_base_url}"
-                f"?client_id={settings.STRAVA_CLIENT_ID}"
-                f"&response_type=code"
-                f"&redirect_uri={redirect_uri}"
-                f"&approval_prompt=force"
-                f"&scope=activity:read,profile:read_all"
-            )
-            
-            logger.info(f"Returning auth URL: {auth_url[:60]}...")
-            return {"auth_url": auth_url}
-        
-        # We have the code, now exchange it for tokens
-        logger.info(f"Code provided, exchanging for tokens: {code[:10] if code else ''}")
-        
-        # First verify the token again
-        logger.debug(f"Verifying token for code exchange: {token[:5] if token else ''}")
-        verification = (
-            db.query(models.VerificationToken)
-            .filter(
-                models.VerificationToken.user_id == user_id,
-                models.VerificationToken.token == token,
-                models.VerificationToken.type == "strava",
-                models.VerificationToken.used == False,
-                models.VerificationToken.expires_at > datetime.now()
-            )
-            .first()
+        # Save token, user and leaderboard changes, retrying lost insert races
+        user = await _save_strava_connection(
+            db, request, user_id, token, token_response, verification, user
         )
         
-        if not verification:
-            logger.warning(f"Invalid or expired Strava authentication token: {token[:5] if token else ''}")
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Invalid or expired Strava authentication token",
-            )
-        
-        # Get user
-        logger.debug(f"Getting user {user_id}")
-        user = db.query(models.User).filter(models.User.id == user_id).first()
-        if not user:
-            logger.warning(f"User not found: {user_id}")
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User not found",
-            )
+        # The token is used now, so it must not be served from the cache anymore
+        _verification_cache.pop(_verification_cache_key(user_id, token), None)
         
-        # Exchange authorization code for tokens
-        logger.debug("Exchanging authorization code for tokens")
-        redirect_uri = f"{settings.FRONTEND_URL}/strava-auth/{user_id}/{token}?frontend_redirect=true"
-        token_response = await exchange_authorization_code(code, redirect_uri)
-        
-        # Log the token response (be careful not to log sensitive data in production)
-        if token_response:
-            logger.debug(f"Token response received with keys: {list(token_response.keys())}")
-            if "errors" in token_response:
-                logger.error(f"Strava API errors: {token_response['errors']}")
-            if "error" in token_response:
-                logger.error(f"Strava API error: {token_response['error']}")
-        else:
-            logger.error("No token response received from Strava")
-        
-        if not token_response or "error" in token_response or "errors" in token_response:
-            error_msg = token_response.get("error", "Unknown error") if token_response else "Failed to get token"
-            logger.error(f"Failed to connect to Strava: {error_msg}")
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Failed to connect to Strava: {error_msg}",
-            )
-        
-        # Get athlete data
-        logger.debug("Getting athlete data from token response")
-        athlete = token_response.get("athlete", {})
+        # Send confirmation email without waiting for SMTP
+        logger.debug("Scheduling confirmation email to %s", user.email)
+        enqueue_email(
+            send_strava_connected_email,
+            user.email,
+            user.first_name
+        )
         
-        try:
-            # Save token to database
-            logger.debug(f"Saving token to database for user: {user_id}")
-            existing_token = db.query(models.Token).filter(models.Token.user_id == user_id).first()
-            
-            if existing_token:
-                # Update existing token
-                logger.debug("Updating existing token")
-                existing_token.access_token = token_response["access_token"]
-                existing_token.refresh_token = token_response["refresh_token"]
-                existing_token.token_type = token_response["token_type"]
-                existing_token.expires_at = token_response["expires_at"]
-                existing_token.updated_at = datetime.now()
-            else:
-                # Create new token
-                logger.debug("Creating new token")
-                new_token = models.Token(
-                    user_id=user_id,
-                    access_token=token_response["access_token"],
-                    refresh_token=token_response["refresh_token"],
-                    token_type=token_response["token_type"],
-                    expires_at=token_response["expires_at"],
+    except IntegrityError as e:
+        # The transaction has already been rolled back by the retry decorator
+        # Check if this is a duplicate Strava ID error
+        if _is_duplicate_strava_id(e):
+            # Find which user has this Strava ID
+            strava_id = str(athlete.get("id", ""))
+            result = await db.execute(
+                select(models.User).filter(
+                    models.User.strava_id == strava_id,
+                    models.User.is_active == True
                 )
-                db.add(new_token)
-            
-            # Update user with Strava information
-            logger.debug(f"Updating user with Strava information: ID {athlete.get('id', '')}")
-            user.strava_id = str(athlete.get("id", ""))
-            user.strava_username = athlete.get("username", "")
-            user.is_strava_connected = True
-            
-            # Mark verification token as used
-            logger.debug("Marking verification token as used")
-            verification.used = True
-            
-            # Log the event
-            logger.debug("Creating audit log entry")
-            audit_log = models.AuditLog(
-                user_id=user_id,
-                event_type="strava_connected",
-                description=f"User {user.email} connected Strava account",
-                ip_address=request.client.host if request.client else None,
-                user_agent=request.headers.get("user-agent"),
             )
-            db.add(audit_log)
-            
-            # Commit all changes
-            logger.debug("Committing database changes")
-            db.commit()
-            
-            # Send confirmation email
-            logger.debug(f"Sending confirmation email to {user.email}")
-            send_strava_connected_email(user.email, user.first_name)
-            
-            # Create initial leaderboard entry
-            logger.debug(f"Creating or updating leaderboard entry for user: {user_id}")
-            leaderboard_entry = db.query(models.Leaderboard).filter(models.Leaderboard.id == user_id).first()
-            if not leaderboard_entry:
-                new_entry = models.Leaderboard(
-                    id=user_id,
-                    first_name=user.first_name,
-                    last_name=user.last_name,
-                    activity_count=0,
-                    last_updated=datetime.now()
-                )
-                db.add(new_entry)
-                db.commit()
-            
-        except IntegrityError as e:
-            # Rollback the transaction
-            db.rollback()
+            existing_user = result.scalars().first()
             
-            # Check if this is a duplicate Strava ID error
-            error_text = str(e)
-            if "ix_users_strava_id" in error_text and "duplicate key value" in error_text:
-                # Find which user has this Strava ID
-                strava_id = str(athlete.get("id", ""))
-                existing_user = db.query(models.User).filter(
-                    models.User.strava_id == strava_id,
-                    models.User.is_active == True
-                ).first()
+            if existing_user:
+                user_email = existing_user.email
+                masked_email = mask_email(user_email)
                 
-                if existing_user:
-                    user_email = existing_user.email
-                    masked_email = mask_email(user_email)
-                    
-                    # Create a user-friendly error message
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail=f"This Strava account is already connected to another user ({masked_email}). Please use a different Strava account or contact support if you believe this is an error."
-                    )
-                else:
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail="This Strava account is already connected to another user. Please use a different Strava account or contact support."
-                    )
+                # Create a user-friendly error message
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"This Strava account is already connected to another user ({masked_email}). Please use a different Strava account or contact support if you believe this is an error."
+                )
             else:
-                # Re-raise any other database errors with a user-friendly message
                 raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail="An error occurred while connecting your Strava account. Please try again later."
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="This Strava account is already connected to another user. Please use a different Strava account or contact support."
                 )
+        else:
+            # Re-raise any other database errors with a user-friendly message
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="An error occurred while connecting your Strava account. Please try again later."
+            )
+    
+    logger.info("Strava connection successful")
+    return {
+        "message": "Strava account successfully connected",
+        "redirect_url": f"{settings.FRONTEND_URL}/thank-you"
+    }
+
+
+@router.get("/strava/auth/{user_id}/{token}")
+async def strava_auth(
+    user_id: str,
+    token: str,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+    code: Optional[str] = None,
+    platform: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Handle Strava OAuth callback with authorization code
+    
+    The platform parameter can be used to detect mobile devices:
+    - ios: iOS devices
+    - android: Android devices
+    - web: Desktop browsers (default)
+    """
+    logger.debug("Strava auth called with user_id: %s, token: %s, code: %s", user_id, token[:5], code[:10] if code else None)
+    
+    try:
+        # Without a code this is the initial request, otherwise the callback from Strava
+        if not code:
+            return await _handle_initial(db, user_id, token, response, platform)
+        return await _handle_callback(db, user_id, token, request, code)
         
-        logger.info("Strava connection successful")
-        return {
-            "message": "Strava account successfully connected",
-            "redirect_url": f"{settings.FRONTEND_URL}/thank-you"
-        }
-        
-    except HTTPException:
+    except HTTPException as e:
         # Re-raise HTTP exceptions
-        logger.error(f"HTTP Exception occurred: {traceback.format_exc()}")
+        logger.warning("Strava auth failed with %s: %s", e.status_code, e.detail)
         raise
     except Exception as e:
         # Log unexpected exceptions
-        logger.error(f"Unexpected error in Strava auth: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Unexpected error in Strava auth: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Internal server error: {str(e)}"
@@ -294,7 +343,7 @@ async def strava_auth(
 async def strava_webhook(
     request: Request,
     background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> Dict[str, Any]:
     """
     Handle Strava webhook events (not implemented in this version)
@@ -310,7 +359,7 @@ async def strava_webhook_verification(
     hub_mode: Optional[str] = None,
     hub_verify_token: Optional[str] = None,
     hub_challenge: Optional[str] = None,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> Dict[str, Any]:
     """
     Verify Strava webhook subscription
@@ -329,23 +378,20 @@ def mask_email(email: str) -> str:
     Mask an email address for privacy
     Example: john.doe@example.com -> j***e@e***e.com
     """
-    if not email or '@' not in email:
+    local, _, domain = (email or "").rpartition('@')
+    head, _, tail = domain.partition('.')
+    if not local or not head:
         return "***"
-        
-    local, domain = email.split('@')
-    
-    # Mask the local part
-    if len(local) <= 2:
-        masked_local = local[0] + "*"
-    else:
-        masked_local = local[0] + "*" * (len(local) - 2) + local[-1]
     
-    # Mask the domain (before the dot)
-    domain_parts = domain.split('.')
-    if len(domain_parts[0]) <= 2:
-        masked_domain = domain_parts[0][0] + "*"
-    else:
-        masked_domain = domain_parts[0][0] + "*" * (len(domain_parts[0]) - 2) + domain_parts[0][-1]
+    masked_local = _mask_part(local)
+    masked_domain = _mask_part(head)
     
     # Combine everything
-    return f"{masked_local}@{masked_domain}.{'.'.join(domain_parts[1:])}"
\ No newline at end of file
+    return f"{masked_local}@{masked_domain}.{tail}" if tail else f"{masked_local}@{masked_domain}"
+
+
+def _mask_part(part: str) -> str:
+    """Keep the first and last character of an email part and mask the rest"""
+    if len(part) <= 2:
+        return part[0] + "*"
+    return part[0] + "*" * (len(part) - 2) + part[-1]
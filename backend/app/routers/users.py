@@ -1,15 +1,18 @@
-import secrets
+import hashlib
 import uuid
 from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .. import models
 from ..database import get_db
 from ..core.config import settings
-from ..services.email_service import send_email
+from ..core.tokens import decode_token, encode_token, generate_token
+from ..services.email_service import enqueue_email, send_email
 
 router = APIRouter()
 
@@ -73,34 +76,34 @@ class UnregisterRequest(BaseModel):
 
 
 @router.post("/users/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-def register_user(
+async def register_user(
     user_data: UserRegistration,
-    background_tasks: BackgroundTasks,
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> Any:
     """
     Register a new user
     """
-    # Check if user already exists
-    existing_user = db.query(models.User).filter(models.User.email == user_data.email).first()
-    if existing_user:
-        if existing_user.is_active:
+    # Check if user already exists, reading only the active flag
+    result = await db.execute(select(models.User.is_active).filter(models.User.email == user_data.email))
+    existing_is_active = result.scalar_one_or_none()
+    if existing_is_active is not None:
+        if existing_is_active:
             raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
                 detail="User with this email already exists",
             )
         else:
             # Reactivate user if previously unregistered
+            result = await db.execute(select(models.User).filter(models.User.email == user_data.email))
+            existing_user = result.scalars().one()
             existing_user.is_active = True
             existing_user.terms_accepted = user_data.terms_accepted
             existing_user.data_processing_accepted = user_data.data_processing_accepted
             existing_user.updated_at = datetime.now()
-            db.commit()
-            db.refresh(existing_user)
             
             # Create email verification token
-            create_and_send_verification_token(existing_user, background_tasks, request, db)
+            verify_url = add_verification_token(existing_user, db)
             
             # Log event
             log_event(
@@ -111,6 +114,17 @@ def register_user(
                 request
             )
             
+            await db.commit()
+            await db.refresh(existing_user)
+            
+            # Send email verification
+            enqueue_email(
+                send_verification_email,
+                existing_user.email,
+                existing_user.first_name,
+                verify_url
+            )
+            
             return existing_user
     
     # Create new user
@@ -124,11 +138,11 @@ def register_user(
     )
     
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    # Flush to assign the user id used by the token and audit log
+    await db.flush()
     
-    # Create and send verification token
-    create_and_send_verification_token(user, background_tasks, request, db)
+    # Create verification token
+    verify_url = add_verification_token(user, db)
     
     # Log event
     log_event(
@@ -139,31 +153,43 @@ def register_user(
         request
     )
     
+    # Save the user, token and audit log in one transaction
+    await db.commit()
+    await db.refresh(user)
+    
+    # Send email verification
+    enqueue_email(
+        send_verification_email,
+        user.email,
+        user.first_name,
+        verify_url
+    )
+    
     return user
 
 
 @router.get("/users/verify/{user_id}/{token}")
-def verify_email(
+async def verify_email(
     user_id: uuid.UUID,
     token: str,
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> Dict[str, str]:
     """
     Verify user email with token
     """
     # Get verification token
-    verification = (
-        db.query(models.VerificationToken)
+    result = await db.execute(
+        select(models.VerificationToken)
         .filter(
             models.VerificationToken.user_id == user_id,
-            models.VerificationToken.token == token,
+            models.VerificationToken.token == decode_token(token),
             models.VerificationToken.type == "email",
             models.VerificationToken.used == False,
-            models.VerificationToken.expires_at > datetime.now()
+            models.VerificationToken.expires_at > func.now()
         )
-        .first()
     )
+    verification = result.scalars().first()
     
     if not verification:
         raise HTTPException(
@@ -172,7 +198,8 @@ def verify_email(
         )
     
     # Get user
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    result = await db.execute(select(models.User).filter(models.User.id == user_id))
+    user = result.scalars().first()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -185,8 +212,6 @@ def verify_email(
     # Mark token as used
     verification.used = True
     
-    db.commit()
-    
     # Log event
     log_event(
         db, 
@@ -199,16 +224,16 @@ def verify_email(
     # Create Strava authorization token
     strava_token = models.VerificationToken(
         user_id=user.id,
-        token=secrets.token_urlsafe(32),
+        token=generate_token(),
         type="strava",
-        expires_at=datetime.now() + timedelta(hours=settings.EMAIL_TOKEN_EXPIRE_HOURS),
+        expires_at=func.now() + timedelta(hours=settings.EMAIL_TOKEN_EXPIRE_HOURS),
     )
     
     db.add(strava_token)
-    db.commit()
+    await db.commit()
     
     # Return success with Strava auth URL
-    strava_auth_url = f"{settings.FRONTEND_URL}/strava-auth/{user.id}/{strava_token.token}"
+    strava_auth_url = f"{settings.FRONTEND_URL}/strava-auth/{user.id}/{encode_token(strava_token.token)}"
     
     return {
         "message": "Email verified successfully",
@@ -217,20 +242,22 @@ def verify_email(
 
 
 @router.post("/users/unregister")
-def request_unregister(
+async def request_unregister(
     unregister_data: UnregisterRequest,
-    background_tasks: BackgroundTasks,
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> Dict[str, str]:
     """
     Request to unregister and delete user data
     """
     # Find user
-    user = db.query(models.User).filter(
-        models.User.email == unregister_data.email,
-        models.User.is_active == True
-    ).first()
+    result = await db.execute(
+        select(models.User).filter(
+            models.User.email == unregister_data.email,
+            models.User.is_active == True
+        )
+    )
+    user = result.scalars().first()
     
     if not user:
         # Don't reveal if user exists or not for privacy
@@ -241,24 +268,12 @@ def request_unregister(
     # Create unregister token
     delete_token = models.VerificationToken(
         user_id=user.id,
-        token=secrets.token_urlsafe(32),
+        token=generate_token(),
         type="delete",
-        expires_at=datetime.now() + timedelta(hours=settings.EMAIL_TOKEN_EXPIRE_HOURS),
+        expires_at=func.now() + timedelta(hours=settings.EMAIL_TOKEN_EXPIRE_HOURS),
     )
     
     db.add(delete_token)
-    db.commit()
-    
-    # Build confirmation URL
-    delete_url = f"{settings.FRONTEND_URL}/delete/{user.id}/{delete_token.token}"
-    
-    # Send email
-    background_tasks.add_task(
-        send_delete_confirmation_email,
-        user.email,
-        user.first_name,
-        delete_url
-    )
     
     # Log event
     log_event(
@@ -269,34 +284,46 @@ def request_unregister(
         request
     )
     
+    await db.commit()
+    
+    # Build confirmation URL
+    delete_url = f"{settings.FRONTEND_URL}/delete/{user.id}/{encode_token(delete_token.token)}"
+    
+    # Send email
+    enqueue_email(
+        send_delete_confirmation_email,
+        user.email,
+        user.first_name,
+        delete_url
+    )
+    
     return {
         "message": "If your email is registered, you will receive an unregister confirmation link"
     }
 
 
 @router.get("/users/delete/{user_id}/{token}")
-def confirm_delete(
+async def confirm_delete(
     user_id: uuid.UUID,
     token: str,
-    background_tasks: BackgroundTasks,
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> Dict[str, str]:
     """
     Confirm user deletion with token
     """
     # Get verification token
-    verification = (
-        db.query(models.VerificationToken)
+    result = await db.execute(
+        select(models.VerificationToken)
         .filter(
             models.VerificationToken.user_id == user_id,
-            models.VerificationToken.token == token,
+            models.VerificationToken.token == decode_token(token),
             models.VerificationToken.type == "delete",
             models.VerificationToken.used == False,
-            models.VerificationToken.expires_at > datetime.now()
+            models.VerificationToken.expires_at > func.now()
         )
-        .first()
     )
+    verification = result.scalars().first()
     
     if not verification:
         raise HTTPException(
@@ -305,7 +332,8 @@ def confirm_delete(
         )
     
     # Get user
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    result = await db.execute(select(models.User).filter(models.User.id == user_id))
+    user = result.scalars().first()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -325,9 +353,10 @@ def confirm_delete(
     verification.used = True
     
     # Remove from leaderboard
-    leaderboard_entry = db.query(models.Leaderboard).filter(models.Leaderboard.id == user_id).first()
+    result = await db.execute(select(models.Leaderboard).filter(models.Leaderboard.id == user_id))
+    leaderboard_entry = result.scalars().first()
     if leaderboard_entry:
-        db.delete(leaderboard_entry)
+        await db.delete(leaderboard_entry)
     
     # Log event
     log_event(
@@ -338,10 +367,10 @@ def confirm_delete(
         request
     )
     
-    db.commit()
+    await db.commit()
     
     # Send confirmation email
-    background_tasks.add_task(
+    enqueue_email(
         send_deletion_complete_email,
         user_email,
         user_first_name
@@ -353,73 +382,85 @@ def confirm_delete(
 
 
 @router.get("/users/leaderboard", response_model=List[Dict[str, Any]])
-def get_leaderboard(
+async def get_leaderboard(
+    request: Request,
     limit: int = 20,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> List[Dict[str, Any]]:
     """
     Get leaderboard with top users
     """
-    leaderboard = (
-        db.query(models.Leaderboard)
+    # Entries only change when an activity is counted or a user is removed, so the
+    # latest update time, entry count and total activities identify the current version;
+    # last_updated is the writer's transaction start, so a long transaction committing
+    # after a newer one leaves it unchanged, and only the total shows its counts
+    result = await db.execute(
+        select(
+            func.max(models.Leaderboard.last_updated),
+            func.count(),
+            func.coalesce(func.sum(models.Leaderboard.activity_count), 0)
+        )
+        .select_from(models.Leaderboard)
+    )
+    last_updated, entry_count, activity_total = result.one()
+    etag = 'W/"' + hashlib.md5(
+        f"{last_updated}:{entry_count}:{activity_total}:{limit}".encode()
+    ).hexdigest() + '"'
+    cache_headers = {"ETag": etag, "Cache-Control": "public, max-age=30"}
+    
+    # Let polling clients reuse their copy when nothing changed
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+    
+    # Select only the returned columns, so no ORM objects (or lazy loads) are involved
+    result = await db.execute(
+        select(
+            models.Leaderboard.first_name,
+            models.Leaderboard.last_name,
+            models.Leaderboard.activity_count
+        )
         .order_by(models.Leaderboard.activity_count.desc())
         .limit(limit)
-        .all()
     )
     
-    return [
-        {
-            "first_name": entry.first_name,
-            "last_name": entry.last_name,
-            "activity_count": entry.activity_count,
-        }
-        for entry in leaderboard
-    ]
+    # Return the rows directly, skipping response_model validation of an untyped list of dicts
+    return ORJSONResponse([
+        {"first_name": first_name, "last_name": last_name, "activity_count": activity_count}
+        for first_name, last_name, activity_count in result
+    ], headers=cache_headers)
 
 
 # Helper functions
-def create_and_send_verification_token(
+def add_verification_token(
     user: models.User,
-    background_tasks: BackgroundTasks,
-    request: Request,
-    db: Session
-) -> None:
-    """Create and send email verification token"""
+    db: AsyncSession
+) -> str:
+    """Add an email verification token to the session and return the verification URL"""
     # Generate verification token
-    token = secrets.token_urlsafe(32)
-    expires = datetime.now() + timedelta(hours=settings.EMAIL_TOKEN_EXPIRE_HOURS)
+    token = generate_token()
     
-    # Save token to database
+    # Save token to database, with the expiry on the database clock its checks compare against
     verification = models.VerificationToken(
         user_id=user.id,
         token=token,
         type="email",
-        expires_at=expires,
+        expires_at=func.now() + timedelta(hours=settings.EMAIL_TOKEN_EXPIRE_HOURS),
     )
     
     db.add(verification)
-    db.commit()
     
     # Build verification URL
-    verify_url = f"{settings.FRONTEND_URL}/email-verify/{user.id}/{token}"
-    
-    # Send email verification
-    background_tasks.add_task(
-        send_verification_email,
-        user.email,
-        user.first_name,
-        verify_url
-    )
+    return f"{settings.FRONTEND_URL}/email-verify/{user.id}/{encode_token(token)}"
 
 
 def log_event(
-    db: Session,
+    db: AsyncSession,
     user_id: Optional[uuid.UUID],
     event_type: str,
     description: str,
     request: Request
 ) -> None:
-    """Log system event"""
+    """Log system event, committed together with the caller's transaction"""
     audit_log = models.AuditLog(
         user_id=user_id,
         event_type=event_type,
@@ -429,11 +470,10 @@ def log_event(
     )
     
     db.add(audit_log)
-    db.commit()
 
 
 # Email sending functions
-def send_verification_email(email: str, first_name: str, verify_url: str) -> None:
+def send_verification_email(email: str, first_name: str, verify_url: str) -> bool:
     """Send email verification email"""
     subject = f"{settings.PROJECT_NAME} - Verify Your Email"
     content = f"""
@@ -450,11 +490,10 @@ def send_verification_email(email: str, first_name: str, verify_url: str) -> Non
     </html>
     """
     
-    from ..services.email_service import send_email
-    send_email(email, subject, content)
+    return send_email(email, subject, content)
 
 
-def send_delete_confirmation_email(email: str, first_name: str, delete_url: str) -> None:
+def send_delete_confirmation_email(email: str, first_name: str, delete_url: str) -> bool:
     """Send confirmation email for account deletion"""
     subject = f"{settings.PROJECT_NAME} - Confirm Account Deletion"
     content = f"""
@@ -471,11 +510,10 @@ def send_delete_confirmation_email(email: str, first_name: str, delete_url: str)
     </html>
     """
     
-    from ..services.email_service import send_email
-    send_email(email, subject, content)
+    return send_email(email, subject, content)
 
 
-def send_deletion_complete_email(email: str, first_name: str) -> None:
+def send_deletion_complete_email(email: str, first_name: str) -> bool:
     """Send confirmation email that account deletion is complete"""
     subject = f"{settings.PROJECT_NAME} - Account Deleted"
     content = f"""
@@ -489,5 +527,4 @@ def send_deletion_complete_email(email: str, first_name: str) -> None:
     </html>
     """
     
-    from ..services.email_service import send_email
-    send_email(email, subject, content)
\ No newline at end of file
+    return send_email(email, subject, content)
\ No newline at end of file
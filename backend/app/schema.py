@@ -0,0 +1,83 @@
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from . import models  # noqa: F401 - registers the tables on Base.metadata
+from .database import Base
+
+logger = logging.getLogger("schema")
+
+# Lets a single app worker upgrade the schema at a time
+SCHEMA_LOCK_KEY = 0x6B6D7473
+
+
+def upgrade_schema(conn: Connection) -> None:
+    """
+    Bring the database up to the current models, creating missing tables,
+    columns and indexes. create_all alone never alters existing tables.
+    Every step is idempotent, so this is safe to run on each start.
+
+    Args:
+        conn: Connection inside a transaction, released with it
+    """
+    # Serialize concurrent app workers; the lock is held until the transaction ends
+    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+
+    _drop_text_verification_tokens(conn)
+    Base.metadata.create_all(conn)
+
+    # Columns added to existing tables
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS strava_ride_count INTEGER"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS strava_activities_etag VARCHAR"))
+
+    # Indexes added to existing tables; the unique filename index needs duplicates gone first
+    _merge_duplicate_source_gpxs(conn)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _drop_text_verification_tokens(conn: Connection) -> None:
+    """
+    Drop verification_tokens if its token column still holds text, so create_all
+    recreates it with binary tokens. Tokens are short-lived one-time links, so
+    outstanding ones are discarded rather than converted.
+    """
+    data_type = conn.execute(text(
+        "SELECT data_type FROM information_schema.columns"
+        " WHERE table_schema = current_schema()"
+        " AND table_name = 'verification_tokens' AND column_name = 'token'"
+    )).scalar()
+    if data_type is not None and data_type != "bytea":
+        logger.warning("Recreating verification_tokens with binary tokens; outstanding links are invalidated")
+        conn.execute(text("DROP TABLE verification_tokens"))
+
+
+def _merge_duplicate_source_gpxs(conn: Connection) -> None:
+    """
+    Before the unique filename index exists, point activities and attempts of
+    duplicate source GPX rows at the oldest row per filename and delete the rest
+    """
+    if conn.execute(text("SELECT to_regclass('ix_source_gpxs_filename')")).scalar() is not None:
+        return
+
+    duplicates = """
+        WITH ranked AS (
+            SELECT id, first_value(id) OVER (PARTITION BY filename ORDER BY created_at, id) AS keep_id
+            FROM source_gpxs
+        ), duplicates AS (
+            SELECT id, keep_id FROM ranked WHERE id <> keep_id
+        )
+    """
+    for table in ("activities", "activity_attempts"):
+        conn.execute(text(
+            duplicates
+            + f"UPDATE {table} SET source_gpx_id = duplicates.keep_id"
+            " FROM duplicates WHERE source_gpx_id = duplicates.id"
+        ))
+    result = conn.execute(text(
+        duplicates + "DELETE FROM source_gpxs USING duplicates WHERE source_gpxs.id = duplicates.id"
+    ))
+    if result.rowcount:
+        logger.warning(f"Merged {result.rowcount} duplicate source GPX rows")
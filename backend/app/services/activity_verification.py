@@ -1,21 +1,68 @@
-from datetime import datetime
-from typing import Dict, List, Tuple
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Tuple, Union
 
-from sqlalchemy.orm import Session
+import numpy as np
+from cachetools import LRUCache
+from sqlalchemy import func, insert, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .. import models
 from ..core.config import settings
-from .gpx_comparison import convert_strava_streams_to_points, verify_activity_against_source
-from .source_gpx_service import load_source_gpx_file
+from .gpx_comparision import (
+    SourceRoute,
+    convert_strava_streams_to_points,
+    verify_activity_against_source
+)
+from .source_gpx_service import get_source_route_from_file
 from .strava_service import (
     ensure_fresh_token, 
     get_activity_by_id, 
     get_activity_streams
 )
 
+# Worker processes for the CPU-bound route comparisons, which would otherwise hold the GIL
+_verify_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+# Parsed source routes keyed by (source id, updated_at), so editing a source invalidates its entry
+_source_routes = LRUCache(maxsize=64)
+
+
+def parse_start_date(value: str) -> datetime:
+    """
+    Parse a Strava ISO 8601 timestamp into the naive UTC datetime stored in the database
+    """
+    return datetime.fromisoformat(value).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+async def get_source_route(source_gpx: models.SourceGPX) -> Tuple[bool, Union[SourceRoute, str]]:
+    """
+    Get the parsed route for a source GPX, loading and parsing it only once per version
+    
+    Args:
+        source_gpx: Source GPX row
+        
+    Returns:
+        Tuple of (success, SourceRoute or error message)
+    """
+    key = (source_gpx.id, source_gpx.updated_at)
+    source_route = _source_routes.get(key)
+    if source_route is not None:
+        return True, source_route
+    
+    success, source_route = await get_source_route_from_file(source_gpx.filename)
+    if not success:
+        return False, source_route
+    
+    _source_routes[key] = source_route
+    return True, source_route
+
 
 async def verify_strava_activity(
-    db: Session,
+    db: AsyncSession,
     user_id: str,
     activity_id: str,
     source_gpx_id: str = None
@@ -40,8 +87,11 @@ async def verify_strava_activity(
             "message": f"Failed to get valid token: {token_value}"
         }
     
-    # Get activity details
-    activity_details = await get_activity_by_id(token_value, activity_id)
+    # Get activity details and streams (GPS data) concurrently
+    activity_details, streams = await asyncio.gather(
+        get_activity_by_id(token_value, activity_id),
+        get_activity_streams(token_value, activity_id)
+    )
     if "error" in activity_details:
         return {
             "success": False,
@@ -55,8 +105,7 @@ async def verify_strava_activity(
             "message": f"Activity is not a bike ride (type: {activity_details.get('type')})"
         }
     
-    # Get activity streams (GPS data)
-    streams = await get_activity_streams(token_value, activity_id)
+    # Check the streams were fetched
     if "error" in streams:
         return {
             "success": False,
@@ -64,15 +113,15 @@ async def verify_strava_activity(
         }
     
     # Convert streams to points
-    activity_points = convert_strava_streams_to_points(streams)
-    if not activity_points:
+    activity_points, cumulative_distance = convert_strava_streams_to_points(streams)
+    if not len(activity_points):
         return {
             "success": False,
             "message": "No GPS data found in activity"
         }
     
-    # Get activity distance
-    activity_distance = activity_details.get("distance", 0)  # in meters
+    # Get activity distance along the GPS track
+    activity_distance = float(cumulative_distance[-1])  # in meters
     
     # If source_gpx_id provided, verify against that specific source
     if source_gpx_id:
@@ -89,22 +138,28 @@ async def verify_strava_activity(
 
 
 async def verify_against_specific_source(
-    db: Session,
+    db: AsyncSession,
     user_id: str,
     activity_id: str,
     source_gpx_id: str,
     activity_details: Dict[str, any],
-    activity_points: List[Tuple[float, float]],
+    activity_points: np.ndarray,
     activity_distance: float
 ) -> Dict[str, any]:
     """
     Verify activity against a specific source GPX
     """
+    # Parse the start date once for the attempt and activity rows
+    start_date = parse_start_date(activity_details.get("start_date"))
+    
     # Get source GPX
-    source_gpx = db.query(models.SourceGPX).filter(
-        models.SourceGPX.id == source_gpx_id,
-        models.SourceGPX.is_active == True
-    ).first()
+    result = await db.execute(
+        select(models.SourceGPX).filter(
+            models.SourceGPX.id == source_gpx_id,
+            models.SourceGPX.is_active == True
+        )
+    )
+    source_gpx = result.scalars().first()
     
     if not source_gpx:
         return {
@@ -112,17 +167,18 @@ async def verify_against_specific_source(
             "message": f"Source GPX with ID {source_gpx_id} not found or inactive"
         }
     
-    # Load source GPX file
-    load_success, content = await load_source_gpx_file(source_gpx.filename)
+    # Get parsed source route
+    load_success, source_route = await get_source_route(source_gpx)
     if not load_success:
         return {
             "success": False,
-            "message": f"Failed to load source GPX file: {content}"
+            "message": f"Failed to load source GPX file: {source_route}"
         }
     
-    # Verify activity against source
-    verification_result = verify_activity_against_source(
-        content, activity_points, activity_distance
+    # Verify activity against source in a worker process
+    loop = asyncio.get_running_loop()
+    verification_result = await loop.run_in_executor(
+        _verify_pool, verify_activity_against_source, source_route, activity_points, activity_distance
     )
     
     # Record verification attempt
@@ -133,7 +189,7 @@ async def verify_against_specific_source(
         name=activity_details.get("name", "Unknown Activity"),
         distance=activity_distance,
         duration=activity_details.get("elapsed_time", 0),
-        start_date=datetime.fromisoformat(activity_details.get("start_date").replace("Z", "+00:00")),
+        start_date=start_date,
         is_verified=verification_result["verified"],
         similarity_score=verification_result["similarity_score"],
         verification_message=verification_result["message"]
@@ -144,9 +200,12 @@ async def verify_against_specific_source(
     # If verified, record as approved activity
     if verification_result["verified"]:
         # Check if already recorded
-        existing = db.query(models.Activity).filter(
-            models.Activity.strava_activity_id == activity_id
-        ).first()
+        result = await db.execute(
+            select(models.Activity).filter(
+                models.Activity.strava_activity_id == activity_id
+            )
+        )
+        existing = result.scalars().first()
         
         if not existing:
             # Add new approved activity
@@ -157,7 +216,7 @@ async def verify_against_specific_source(
                 name=activity_details.get("name", "Unknown Activity"),
                 distance=activity_distance,
                 duration=activity_details.get("elapsed_time", 0),
-                start_date=datetime.fromisoformat(activity_details.get("start_date").replace("Z", "+00:00")),
+                start_date=start_date,
                 similarity_score=verification_result["similarity_score"]
             )
             
@@ -166,7 +225,7 @@ async def verify_against_specific_source(
             # Update leaderboard
             await update_leaderboard(db, user_id)
     
-    db.commit()
+    await db.commit()
     
     return {
         "success": True,
@@ -181,20 +240,26 @@ async def verify_against_specific_source(
 
 
 async def verify_against_all_sources(
-    db: Session,
+    db: AsyncSession,
     user_id: str,
     activity_id: str,
     activity_details: Dict[str, any],
-    activity_points: List[Tuple[float, float]],
+    activity_points: np.ndarray,
     activity_distance: float
 ) -> Dict[str, any]:
     """
     Verify activity against all active source GPXs
     """
+    # Parse the start date once for the attempt and activity rows
+    start_date = parse_start_date(activity_details.get("start_date"))
+    
     # Get all active source GPXs
-    source_gpxs = db.query(models.SourceGPX).filter(
-        models.SourceGPX.is_active == True
-    ).all()
+    result = await db.execute(
+        select(models.SourceGPX).filter(
+            models.SourceGPX.is_active == True
+        )
+    )
+    source_gpxs = result.scalars().all()
     
     if not source_gpxs:
         return {
@@ -209,53 +274,80 @@ async def verify_against_all_sources(
         "source_gpx": None
     }
     
-    # Check against each source
-    for source_gpx in source_gpxs:
-        # Load source GPX file
-        load_success, content = await load_source_gpx_file(source_gpx.filename)
+    # Get all parsed source routes concurrently
+    loaded = await asyncio.gather(
+        *[get_source_route(source_gpx) for source_gpx in source_gpxs]
+    )
+    
+    sources = []
+    for source_gpx, (load_success, source_route) in zip(source_gpxs, loaded):
         if not load_success:
-            print(f"Failed to load source GPX file {source_gpx.filename}: {content}")
+            print(f"Failed to load source GPX file {source_gpx.filename}: {source_route}")
             continue
-        
-        # Verify activity against source
-        verification_result = verify_activity_against_source(
-            content, activity_points, activity_distance
-        )
-        
-        # Record verification attempt
-        activity_attempt = models.ActivityAttempt(
-            user_id=user_id,
-            strava_activity_id=activity_id,
-            source_gpx_id=source_gpx.id,
-            name=activity_details.get("name", "Unknown Activity"),
-            distance=activity_distance,
-            duration=activity_details.get("elapsed_time", 0),
-            start_date=datetime.fromisoformat(activity_details.get("start_date").replace("Z", "+00:00")),
-            is_verified=verification_result["verified"],
-            similarity_score=verification_result["similarity_score"],
-            verification_message=verification_result["message"]
-        )
-        
-        db.add(activity_attempt)
-        
-        # Keep track of best match
-        if verification_result["similarity_score"] > best_result["similarity_score"]:
-            best_result = {
-                "verified": verification_result["verified"],
+        sources.append((source_gpx, source_route))
+    
+    # Verify activity against all sources in parallel worker processes
+    loop = asyncio.get_running_loop()
+    pending = {
+        loop.run_in_executor(
+            _verify_pool, verify_activity_against_source, source_route, activity_points, activity_distance
+        ): source_gpx
+        for source_gpx, source_route in sources
+    }
+    
+    # Check results for each source as they complete
+    attempts = []
+    while pending:
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            source_gpx = pending.pop(future)
+            verification_result = future.result()
+            
+            # Record verification attempt
+            attempts.append({
+                "user_id": user_id,
+                "strava_activity_id": activity_id,
+                "source_gpx_id": source_gpx.id,
+                "name": activity_details.get("name", "Unknown Activity"),
+                "distance": activity_distance,
+                "duration": activity_details.get("elapsed_time", 0),
+                "start_date": start_date,
+                "is_verified": verification_result["verified"],
                 "similarity_score": verification_result["similarity_score"],
-                "message": verification_result["message"],
-                "source_gpx": {
-                    "id": source_gpx.id,
-                    "name": source_gpx.name
+                "verification_message": verification_result["message"]
+            })
+            
+            # Keep track of best match
+            if verification_result["similarity_score"] > best_result["similarity_score"]:
+                best_result = {
+                    "verified": verification_result["verified"],
+                    "similarity_score": verification_result["similarity_score"],
+                    "message": verification_result["message"],
+                    "source_gpx": {
+                        "id": source_gpx.id,
+                        "name": source_gpx.name
+                    }
                 }
-            }
+        
+        # A near-certain match can't be beaten meaningfully, so skip comparisons not started yet
+        if best_result["similarity_score"] >= settings.VERIFY_SHORTCIRCUIT_THRESHOLD:
+            for future in pending:
+                future.cancel()
+            break
+    
+    # Save all verification attempts in a single INSERT
+    if attempts:
+        await db.execute(insert(models.ActivityAttempt), attempts)
     
     # If verified, record as approved activity
     if best_result["verified"]:
         # Check if already recorded
-        existing = db.query(models.Activity).filter(
-            models.Activity.strava_activity_id == activity_id
-        ).first()
+        result = await db.execute(
+            select(models.Activity).filter(
+                models.Activity.strava_activity_id == activity_id
+            )
+        )
+        existing = result.scalars().first()
         
         if not existing:
             # Add new approved activity
@@ -266,7 +358,7 @@ async def verify_against_all_sources(
                 name=activity_details.get("name", "Unknown Activity"),
                 distance=activity_distance,
                 duration=activity_details.get("elapsed_time", 0),
-                start_date=datetime.fromisoformat(activity_details.get("start_date").replace("Z", "+00:00")),
+                start_date=start_date,
                 similarity_score=best_result["similarity_score"]
             )
             
@@ -275,7 +367,7 @@ async def verify_against_all_sources(
             # Update leaderboard
             await update_leaderboard(db, user_id)
     
-    db.commit()
+    await db.commit()
     
     return {
         "success": True,
@@ -283,40 +375,32 @@ async def verify_against_all_sources(
     }
 
 
-async def update_leaderboard(db: Session, user_id: str) -> None:
+async def update_leaderboard(db: AsyncSession, user_id: str) -> None:
     """
-    Update leaderboard entry for user
+    Count one more approved activity on the user's leaderboard entry,
+    creating the entry on the first one. Committed with the caller's transaction.
     
     Args:
         db: Database session
         user_id: User ID
     """
-    # Get user
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    if not user:
-        return
-    
-    # Count approved activities
-    activity_count = db.query(models.Activity).filter(
-        models.Activity.user_id == user_id
-    ).count()
-    
-    # Update or create leaderboard entry
-    leaderboard_entry = db.query(models.Leaderboard).filter(
-        models.Leaderboard.id == user_id
-    ).first()
-    
-    if leaderboard_entry:
-        leaderboard_entry.activity_count = activity_count
-        leaderboard_entry.last_updated = datetime.now()
-    else:
-        new_entry = models.Leaderboard(
-            id=user_id,
-            first_name=user.first_name,
-            last_name=user.last_name,
-            activity_count=activity_count,
-            last_updated=datetime.now()
+    await db.execute(
+        pg_insert(models.Leaderboard)
+        .from_select(
+            ["id", "first_name", "last_name", "activity_count", "last_updated"],
+            select(
+                models.User.id,
+                models.User.first_name,
+                models.User.last_name,
+                literal(1),
+                func.now()
+            ).filter(models.User.id == user_id)
         )
-        db.add(new_entry)
-    
-    db.commit()
\ No newline at end of file
+        .on_conflict_do_update(
+            index_elements=[models.Leaderboard.id],
+            set_={
+                "activity_count": models.Leaderboard.activity_count + 1,
+                "last_updated": func.now()
+            }
+        )
+    )
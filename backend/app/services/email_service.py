@@ -1,12 +1,44 @@
+import queue
 import smtplib
 import ssl
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import List, Optional
+from typing import Any, Callable, List, Optional
 
 from ..core.config import settings
 
 
+class _TokenBucket:
+    """Thread-safe token bucket limiting how fast emails are handed to the SMTP server"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take one token, sleeping until one is available"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Keeps bursts of emails under the SMTP provider's per-second limit
+_send_bucket = _TokenBucket(rate=settings.SMTP_RATE_PER_SEC, burst=settings.SMTP_BURST)
+
+
 def send_email(
     to_email: str,
     subject: str,
@@ -33,47 +65,139 @@ def send_email(
     msg["From"] = settings.SMTP_FROM
     msg["To"] = to_email
     
-    # Add CC recipients if provided
+    # Add CC and BCC recipients if provided (send_message strips the Bcc header)
     if cc_emails:
         msg["Cc"] = ", ".join(cc_emails)
-        
-    # Set recipients list for sending
-    recipients = [to_email]
-    if cc_emails:
-        recipients.extend(cc_emails)
     if bcc_emails:
-        recipients.extend(bcc_emails)
+        msg["Bcc"] = ", ".join(bcc_emails)
         
     # Attach HTML part
     html_part = MIMEText(html_content, "html")
     msg.attach(html_part)
     
-    # Create secure SSL context
-    context = ssl.create_default_context()
-    
+    connection = None
     try:
-        # Connect to server and send email
-        if settings.SMTP_PORT == 1025:  # For Mailpit testing (no auth, no SSL/TLS)
-            with smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT) as server:
-                server.sendmail(settings.SMTP_FROM, recipients, msg.as_string())
-        elif settings.SMTP_PORT == 465:  # For SSL connections
-            with smtplib.SMTP_SSL(settings.SMTP_SERVER, settings.SMTP_PORT, context=context) as server:
-                server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
-                server.sendmail(settings.SMTP_FROM, recipients, msg.as_string())
-        else:  # For TLS connections (usually port 587)
-            with smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT) as server:
-                server.ehlo()
-                server.starttls(context=context)
-                server.ehlo()
-                server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
-                server.sendmail(settings.SMTP_FROM, recipients, msg.as_string())
+        # Wait for the rate limit, then reuse a pooled connection and stream the message to it
+        _send_bucket.acquire()
+        connection = _get_connection()
+        connection.send_message(msg)
+        _release_connection(connection)
         return True
     except Exception as e:
+        # Never return a connection in an unknown state to the pool
+        if connection is not None:
+            _close_connection(connection)
         # Log the error
         print(f"Error sending email: {e}")
         return False
 
 
+# Idle SMTP connections ready for reuse by the next email
+_connection_pool: "queue.Queue[smtplib.SMTP]" = queue.Queue(maxsize=settings.SMTP_POOL_SIZE)
+
+# Secure SSL context, built once since loading the trust store is costly
+_ssl_context = ssl.create_default_context()
+
+
+def _connect() -> smtplib.SMTP:
+    """Open and authenticate a new SMTP connection for the configured port"""
+    if settings.SMTP_PORT == 1025:  # For Mailpit testing (no auth, no SSL/TLS)
+        return smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT)
+    
+    if settings.SMTP_PORT == 465:  # For SSL connections
+        server = smtplib.SMTP_SSL(settings.SMTP_SERVER, settings.SMTP_PORT, context=_ssl_context)
+    else:  # For TLS connections (usually port 587)
+        server = smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT)
+        server.ehlo()
+        server.starttls(context=_ssl_context)
+        server.ehlo()
+    server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
+    return server
+
+
+def _get_connection() -> smtplib.SMTP:
+    """Take a live connection from the pool, or open a new one"""
+    while True:
+        try:
+            server = _connection_pool.get_nowait()
+        except queue.Empty:
+            return _connect()
+        
+        # The server may have dropped an idle connection
+        try:
+            if server.noop()[0] == 250:
+                return server
+        except (smtplib.SMTPException, OSError):
+            pass
+        _close_connection(server)
+
+
+def _release_connection(server: smtplib.SMTP) -> None:
+    """Return a connection to the pool, closing it if the pool is full"""
+    try:
+        _connection_pool.put_nowait(server)
+    except queue.Full:
+        _close_connection(server)
+
+
+def _close_connection(server: smtplib.SMTP) -> None:
+    """Close a connection, ignoring errors from already broken ones"""
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+# Dedicated threads for sending emails, so SMTP I/O never occupies request or threadpool workers
+_email_executor = ThreadPoolExecutor(max_workers=settings.EMAIL_WORKERS, thread_name_prefix="email")
+
+
+def enqueue_email(sender: Callable[..., bool], *args: Any) -> Future:
+    """
+    Send an email on the email executor, with retries, without waiting for it.
+    
+    Args:
+        sender: Email function returning True on success
+        *args: Arguments passed to the sender
+        
+    Returns:
+        Future resolving to the result of send_with_retry
+    """
+    return _email_executor.submit(send_with_retry, sender, *args)
+
+
+def shutdown_email_executor() -> None:
+    """
+    Wait for queued emails to be sent and stop the email threads.
+    """
+    _email_executor.shutdown(wait=True)
+
+
+def send_with_retry(sender: Callable[..., bool], *args: Any) -> bool:
+    """
+    Call an email sender, retrying with exponential backoff while it fails.
+    Meant to run on the email executor so the waits never block a request.
+    
+    Args:
+        sender: Email function returning True on success
+        *args: Arguments passed to the sender
+        
+    Returns:
+        bool: True if email was sent successfully, False once retries are exhausted
+    """
+    delay = settings.EMAIL_RETRY_BACKOFF_SECONDS
+    for attempt in range(settings.EMAIL_MAX_RETRIES + 1):
+        if sender(*args):
+            return True
+        if attempt < settings.EMAIL_MAX_RETRIES:
+            print(f"Retrying {sender.__name__} in {delay}s (attempt {attempt + 1}/{settings.EMAIL_MAX_RETRIES})")
+            time.sleep(delay)
+            delay *= 2
+
+    print(f"Giving up on {sender.__name__} after {settings.EMAIL_MAX_RETRIES} retries")
+    return False
+
+
 def send_activity_verification_email(
     to_email: str,
     first_name: str,
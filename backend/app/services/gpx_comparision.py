@@ -1,13 +1,49 @@
+import io
 import math
-from typing import Dict, List, Tuple
+from typing import Dict, NamedTuple, Optional, Tuple
+from xml.etree import ElementTree
 
-import gpxpy
-import gpxpy.gpx
-from shapely.geometry import LineString, Point
+import numpy as np
+from shapely.geometry import LineString
 
 from ..core.config import settings
 
 
+# Mean earth radius in meters
+EARTH_RADIUS = 6371000
+
+_DEG_TO_RAD = math.pi / 180
+_HALF_DEG_TO_RAD = _DEG_TO_RAD / 2
+
+# Approximate number of (activity point, source segment) pairs compared at once,
+# which keeps the temporary arrays around 8 MB each
+_DISTANCE_CHUNK_PAIRS = 2 ** 19
+
+# Consecutive activity points per chunk, kept small so each chunk covers a small area
+_ACTIVITY_CHUNK_POINTS = 64
+
+# Version of the saved SourceRoute files; bump when simplification or projection changes
+SOURCE_ROUTE_FORMAT_VERSION = 1
+
+# Verification settings, read once since they don't change while the process runs
+_MIN_DISTANCE_KM = settings.MIN_ACTIVITY_DISTANCE_KM
+_MAX_DEVIATION_METERS = settings.GPS_MAX_DEVIATION_METERS
+_SIMILARITY_THRESHOLD = settings.ROUTE_SIMILARITY_THRESHOLD
+_FULL_REPORT = settings.GPS_FULL_REPORT
+
+
+class SourceRoute(NamedTuple):
+    """Source route prepared once for repeated comparisons"""
+    points: np.ndarray  # Simplified route as (lat, lon) rows
+    point_count: int  # Number of points in the original GPX
+    ref_lat: float  # Reference latitude of the projection to meters
+    seg_start: np.ndarray  # Projected segment start points
+    seg_vec: np.ndarray  # Projected segment vectors from start to end
+    seg_len2: np.ndarray  # Squared segment lengths (1 for zero-length segments)
+    seg_min: np.ndarray  # Segment bounding box lower corners
+    seg_max: np.ndarray  # Segment bounding box upper corners
+
+
 def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """
     Calculate the great circle distance between two points
@@ -22,19 +58,54 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     Returns:
         Distance in meters
     """
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    # Haversine formula, converting degrees with constant multiplies
+    sin_dlat = math.sin((lat2 - lat1) * _HALF_DEG_TO_RAD)
+    sin_dlon = math.sin((lon2 - lon1) * _HALF_DEG_TO_RAD)
+    a = sin_dlat * sin_dlat + math.cos(lat1 * _DEG_TO_RAD) * math.cos(lat2 * _DEG_TO_RAD) * sin_dlon * sin_dlon
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def haversine_batch(
+    lat1: np.ndarray,
+    lon1: np.ndarray,
+    lat2: np.ndarray,
+    lon2: np.ndarray
+) -> np.ndarray:
+    """
+    Calculate great circle distances for arrays of point pairs in decimal degrees
     
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    r = 6371000  # Radius of earth in meters
-    return c * r
+    Args:
+        lat1: Latitudes of the first points
+        lon1: Longitudes of the first points
+        lat2: Latitudes of the second points
+        lon2: Longitudes of the second points
+        
+    Returns:
+        Array of distances in meters
+    """
+    sin_dlat = np.sin((lat2 - lat1) * _HALF_DEG_TO_RAD)
+    sin_dlon = np.sin((lon2 - lon1) * _HALF_DEG_TO_RAD)
+    a = sin_dlat * sin_dlat + np.cos(lat1 * _DEG_TO_RAD) * np.cos(lat2 * _DEG_TO_RAD) * sin_dlon * sin_dlon
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
 
 
-def load_gpx_points(gpx_content: str) -> List[Tuple[float, float]]:
+def route_length(points: np.ndarray) -> float:
+    """
+    Calculate the length of a route along its points
+    
+    Args:
+        points: Array of (lat, lon) rows in degrees
+        
+    Returns:
+        Route length in meters
+    """
+    if len(points) < 2:
+        return 0.0
+    
+    return float(haversine_batch(points[:-1, 0], points[:-1, 1], points[1:, 0], points[1:, 1]).sum())
+
+
+def load_gpx_points(gpx_content: str) -> np.ndarray:
     """
     Load points (latitude, longitude) from GPX content
     
@@ -42,159 +113,296 @@ def load_gpx_points(gpx_content: str) -> List[Tuple[float, float]]:
         gpx_content: GPX file content as string
         
     Returns:
-        List of (latitude, longitude) points
+        Array of (latitude, longitude) rows
     """
-    gpx = gpxpy.parse(gpx_content)
-    points = []
+    # Stream the track points instead of building a full gpxpy object tree
+    coords = []
+    for _, elem in ElementTree.iterparse(io.StringIO(gpx_content)):
+        if elem.tag.endswith("}trkpt") or elem.tag == "trkpt":
+            coords.append(float(elem.get("lat")))
+            coords.append(float(elem.get("lon")))
+            elem.clear()
     
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                points.append((point.latitude, point.longitude))
-    
-    return points
+    return np.array(coords, dtype=np.float64).reshape(-1, 2)
 
 
-def simplify_points(points: List[Tuple[float, float]], tolerance: float = 0.0001) -> List[Tuple[float, float]]:
+def simplify_points(points: np.ndarray, tolerance: float = 0.0001) -> np.ndarray:
     """
-    Simplify a list of points using Douglas-Peucker algorithm
+    Simplify an array of points using Douglas-Peucker algorithm
     
     Args:
-        points: List of (latitude, longitude) points
+        points: Array of (latitude, longitude) rows
         tolerance: Tolerance for simplification
         
     Returns:
-        Simplified list of points
+        Simplified array of points
     """
     if len(points) < 3:
         return points
         
-    line = LineString([(p[1], p[0]) for p in points])  # (lon, lat) for LineString
-    simplified = line.simplify(tolerance)
+    line = LineString(points[:, ::-1])  # (lon, lat) view for LineString
+    # Plain Douglas-Peucker: topology preservation doesn't matter for distance checks
+    simplified = line.simplify(tolerance, preserve_topology=False)
     
     # Convert back to (lat, lon)
-    return [(y, x) for x, y in simplified.coords]
+    return np.asarray(simplified.coords)[:, ::-1]
+
+
+def project_points(points: np.ndarray, ref_lat: float) -> np.ndarray:
+    """
+    Project (lat, lon) points to equirectangular (x, y) meters around a reference latitude
+    
+    Args:
+        points: Array of (lat, lon) rows in degrees
+        ref_lat: Reference latitude in degrees
+        
+    Returns:
+        Array of (x, y) rows in meters
+    """
+    radians = np.radians(points)
+    return np.column_stack((
+        EARTH_RADIUS * math.cos(math.radians(ref_lat)) * radians[:, 1],
+        EARTH_RADIUS * radians[:, 0]
+    ))
+
+
+def prepare_source_route(source_gpx_content: str) -> SourceRoute:
+    """
+    Parse and simplify a source GPX route for comparisons
+    
+    Args:
+        source_gpx_content: GPX file content of source route
+        
+    Returns:
+        SourceRoute with the simplified route and its projected segments
+    """
+    source_points = load_gpx_points(source_gpx_content)
+    simplified = simplify_points(source_points)
+    
+    # Project to meters around the route's mean latitude and split into segments A -> B
+    ref_lat = float(simplified[:, 0].mean())
+    projected = project_points(simplified, ref_lat)
+    seg_start = projected[:-1]
+    seg_end = projected[1:]
+    seg_vec = seg_end - seg_start
+    seg_len2 = (seg_vec * seg_vec).sum(axis=1)
+    seg_len2[seg_len2 == 0] = 1.0  # Zero-length segments: any t gives the start point
+    
+    return SourceRoute(
+        points=simplified,
+        point_count=len(source_points),
+        ref_lat=ref_lat,
+        seg_start=seg_start,
+        seg_vec=seg_vec,
+        seg_len2=seg_len2,
+        seg_min=np.minimum(seg_start, seg_end),
+        seg_max=np.maximum(seg_start, seg_end)
+    )
+
+
+def save_source_route(source_route: SourceRoute, path: str) -> None:
+    """
+    Save a prepared source route to an .npz file
+    
+    Args:
+        source_route: Prepared source route
+        path: File path to write
+    """
+    with open(path, "wb") as f:
+        np.savez(f, version=SOURCE_ROUTE_FORMAT_VERSION, **source_route._asdict())
+
+
+def load_source_route(path: str) -> Optional[SourceRoute]:
+    """
+    Load a prepared source route saved by save_source_route
+    
+    Args:
+        path: File path to read
+        
+    Returns:
+        SourceRoute, or None if the file was saved by another format version
+    """
+    with np.load(path) as data:
+        if int(data["version"]) != SOURCE_ROUTE_FORMAT_VERSION:
+            return None
+        
+        return SourceRoute(
+            points=data["points"],
+            point_count=int(data["point_count"]),
+            ref_lat=float(data["ref_lat"]),
+            seg_start=data["seg_start"],
+            seg_vec=data["seg_vec"],
+            seg_len2=data["seg_len2"],
+            seg_min=data["seg_min"],
+            seg_max=data["seg_max"]
+        )
 
 
 def calculate_similarity(
-    source_points: List[Tuple[float, float]],
-    activity_points: List[Tuple[float, float]],
-    max_deviation: float = 20.0  # Maximum deviation in meters
-) -> Tuple[float, List[Tuple[float, float, float]]]:
+    source_route: SourceRoute,
+    activity_points: np.ndarray,
+    max_deviation: float = 20.0,  # Maximum deviation in meters
+    threshold: Optional[float] = None
+) -> Tuple[float, np.ndarray, bool]:
     """
     Calculate similarity between source route and activity route
     
     Args:
-        source_points: List of (lat, lon) points from source route
-        activity_points: List of (lat, lon) points from activity
+        source_route: Prepared source route from prepare_source_route
+        activity_points: Array of (lat, lon) rows from activity
         max_deviation: Maximum allowed deviation in meters
+        threshold: Optional similarity threshold; the scan stops as soon as the
+            score is known to be above or below it
         
     Returns:
-        Tuple of (similarity_score, list of deviations)
+        Tuple of (similarity_score, array of (lat, lon, deviation) rows, complete).
+        Deviations beyond max_deviation are only known to exceed it (infinite if no
+        segment is nearby). If the scan stopped early, complete is False, the score is
+        the bound that decided it and the deviations of unscanned points are NaN.
     """
-    # Create LineString from source points
-    source_line = LineString([(p[1], p[0]) for p in source_points])  # (lon, lat) for LineString
+    if not len(activity_points):
+        return 0, np.empty((0, 3)), True
+    
+    # Project the activity with the source route's projection
+    projected = project_points(activity_points, source_route.ref_lat)
+    seg_start, seg_vec, seg_len2 = source_route.seg_start, source_route.seg_vec, source_route.seg_len2
+    seg_min, seg_max = source_route.seg_min, source_route.seg_max
     
-    # Check each activity point against the source line
-    deviations = []
-    points_within_threshold = 0
+    # Squared distance from each activity point to its closest nearby source segment,
+    # in chunks of consecutive activity points to cap memory use. Segments outside the
+    # chunk's bounding box grown by max_deviation can't bring any point within threshold.
+    chunk = max(1, min(_ACTIVITY_CHUNK_POINTS, _DISTANCE_CHUNK_PAIRS // len(seg_start)))
+    min_dist2 = np.full(len(projected), np.inf)
+    max_dist2 = max_deviation ** 2
     
-    for lat, lon in activity_points:
-        point = Point(lon, lat)  # (lon, lat) for Point
-        distance = source_line.distance(point) * 111319.9  # Convert degrees to meters (approximate)
-        deviations.append((lat, lon, distance))
+    # Points needed within threshold to pass, and the misses that make passing impossible
+    total = len(projected)
+    required = None
+    if threshold is not None:
+        required = math.ceil(threshold * total)
+        # Rounding in threshold * total can push the ceiling one too high
+        if required and (required - 1) / total >= threshold:
+            required -= 1
+    within = outside = 0
+    
+    for i in range(0, total, chunk):
+        if required is not None and (within >= required or outside > total - required):
+            # The verdict can't change any more
+            min_dist2[i:] = np.nan
+            score = (within if within >= required else total - outside) / total
+            return score, np.column_stack((activity_points, np.sqrt(min_dist2))), False
+        
+        points = projected[i:i + chunk]
+        nearby = (
+            (seg_max >= points.min(axis=0) - max_deviation).all(axis=1)
+            & (seg_min <= points.max(axis=0) + max_deviation).all(axis=1)
+        )
+        if not nearby.any():
+            outside += len(points)
+            continue
         
-        if distance <= max_deviation:
-            points_within_threshold += 1
+        offset = points[:, None] - seg_start[nearby]
+        vec = seg_vec[nearby]
+        t = np.clip((offset * vec).sum(axis=-1) / seg_len2[nearby], 0.0, 1.0)
+        residual = offset - t[..., None] * vec
+        min_dist2[i:i + chunk] = (residual * residual).sum(axis=-1).min(axis=1)
+        
+        chunk_within = int((min_dist2[i:i + chunk] <= max_dist2).sum())
+        within += chunk_within
+        outside += len(points) - chunk_within
     
     # Calculate similarity score (percentage of points within threshold)
-    similarity_score = points_within_threshold / len(activity_points) if activity_points else 0
+    similarity_score = within / total
+    
+    deviations = np.column_stack((activity_points, np.sqrt(min_dist2)))
     
-    return similarity_score, deviations
+    return similarity_score, deviations, True
 
 
 def verify_activity_against_source(
-    source_gpx_content: str,
-    activity_points: List[Tuple[float, float]],
+    source_route: SourceRoute,
+    activity_points: np.ndarray,
     activity_distance: float  # Distance in meters
 ) -> Dict[str, any]:
     """
     Verify if an activity matches a source GPX route
     
     Args:
-        source_gpx_content: GPX file content of source route
-        activity_points: List of (lat, lon) points from activity
+        source_route: Prepared source route from prepare_source_route
+        activity_points: Array of (lat, lon) rows from activity
         activity_distance: Distance of activity in meters
         
     Returns:
         Dict with verification results
     """
     # Check minimum distance requirement
-    required_distance = settings.MIN_ACTIVITY_DISTANCE_KM * 1000  # Convert to meters
+    required_distance = _MIN_DISTANCE_KM * 1000  # Convert to meters
     if activity_distance < required_distance:
         return {
             "verified": False,
             "similarity_score": 0.0,
-            "message": f"Activity distance ({activity_distance/1000:.1f}km) is less than required ({settings.MIN_ACTIVITY_DISTANCE_KM}km)"
-        }
-    
-    # Load source route points
-    try:
-        source_points = load_gpx_points(source_gpx_content)
-    except Exception as e:
-        return {
-            "verified": False,
-            "similarity_score": 0.0,
-            "message": f"Error loading source GPX: {str(e)}"
+            "message": f"Activity distance ({activity_distance/1000:.1f}km) is less than required ({_MIN_DISTANCE_KM}km)"
         }
     
     # Check if we have enough points
-    if len(source_points) < 10 or len(activity_points) < 10:
+    if source_route.point_count < 10 or len(activity_points) < 10:
         return {
             "verified": False,
             "similarity_score": 0.0,
             "message": "Not enough GPS points to perform verification"
         }
     
-    # Simplify routes for faster comparison
-    source_points = simplify_points(source_points)
+    # Simplify the activity for faster comparison (the source route is already simplified)
     activity_points = simplify_points(activity_points)
     
     # Calculate similarity
-    similarity_score, deviations = calculate_similarity(
-        source_points,
+    # (stopping once the verdict is known, unless a full report is configured)
+    similarity_score, deviations, complete = calculate_similarity(
+        source_route,
         activity_points,
-        max_deviation=settings.GPS_MAX_DEVIATION_METERS
+        max_deviation=_MAX_DEVIATION_METERS,
+        threshold=None if _FULL_REPORT else _SIMILARITY_THRESHOLD
     )
     
     # Check if similarity meets threshold
-    verified = similarity_score >= settings.ROUTE_SIMILARITY_THRESHOLD
+    verified = similarity_score >= _SIMILARITY_THRESHOLD
+    bound = "" if complete else ("at least " if verified else "at most ")
     
     return {
         "verified": verified,
         "similarity_score": similarity_score,
         "message": (
-            f"Route verified successfully with {similarity_score:.1%} match"
+            f"Route verified successfully with {bound}{similarity_score:.1%} match"
             if verified else
-            f"Route similarity ({similarity_score:.1%}) below required threshold ({settings.ROUTE_SIMILARITY_THRESHOLD:.1%})"
+            f"Route similarity ({bound}{similarity_score:.1%}) below required threshold ({_SIMILARITY_THRESHOLD:.1%})"
         )
     }
 
 
 def convert_strava_streams_to_points(
     streams: Dict[str, any]
-) -> List[Tuple[float, float]]:
+) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Convert Strava API streams to list of points
+    Convert Strava API streams to an array of points
     
     Args:
         streams: Strava API streams response
         
     Returns:
-        List of (lat, lon) points
+        Tuple of (array of (lat, lon) rows, cumulative distance in meters at each point)
     """
     if not streams or "latlng" not in streams:
-        return []
+        return np.empty((0, 2)), np.empty(0)
     
     latlng_data = streams["latlng"]["data"]
-    return [(point[0], point[1]) for point in latlng_data if len(point) == 2]
\ No newline at end of file
+    points = np.array([point for point in latlng_data if len(point) == 2], dtype=np.float64).reshape(-1, 2)
+    
+    # Measure the distance from the GPS track itself rather than the activity summary
+    cumulative_distance = np.zeros(len(points))
+    if len(points) > 1:
+        np.cumsum(
+            haversine_batch(points[:-1, 0], points[:-1, 1], points[1:, 0], points[1:, 1]),
+            out=cumulative_distance[1:]
+        )
+    
+    return points, cumulative_distance
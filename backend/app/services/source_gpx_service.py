@@ -1,14 +1,26 @@
+import asyncio
 import os
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
+import aiofiles
+import aiofiles.os
 import gpxpy
 import gpxpy.gpx
+from cachetools import LRUCache
 from fastapi import UploadFile
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .. import models
 from ..core.config import settings
+from .gpx_comparision import SourceRoute, load_source_route, prepare_source_route, save_source_route
+
+
+# GPX file contents keyed by (path, mtime), so a modified file is read again
+_gpx_contents = LRUCache(maxsize=64)
 
 
 async def load_source_gpx_file(filename: str) -> Tuple[bool, str]:
@@ -24,32 +36,36 @@ async def load_source_gpx_file(filename: str) -> Tuple[bool, str]:
     try:
         file_path = Path(settings.SOURCE_GPX_PATH) / filename
         
-        if not file_path.exists():
+        try:
+            stat = await aiofiles.os.stat(file_path)
+        except FileNotFoundError:
             return False, f"File {filename} not found"
         
-        with open(file_path, "r") as f:
-            content = f.read()
+        # Source files rarely change, so reuse the contents until the file is modified
+        cache_key = (str(file_path), stat.st_mtime)
+        content = _gpx_contents.get(cache_key)
+        if content is None:
+            async with aiofiles.open(file_path, "r") as f:
+                content = await f.read()
+            _gpx_contents[cache_key] = content
         
         return True, content
     except Exception as e:
         return False, f"Error loading GPX file: {str(e)}"
 
 
-async def get_source_gpx_info(filename: str) -> Dict[str, any]:
+def parse_gpx_info(filename: str, content: str) -> Dict[str, any]:
     """
-    Get information about a source GPX file
+    Parse information about a GPX file from its content.
+    Kept at module level so it can run in a worker process.
     
     Args:
-        filename: Name of the GPX file in the source GPX directory
+        filename: Name of the GPX file
+        content: GPX file content
         
     Returns:
         Dictionary with GPX information
     """
-    success, content = await load_source_gpx_file(filename)
-    
-    if not success:
-        return {"error": content}
-    
     try:
         gpx = gpxpy.parse(content)
         
@@ -86,6 +102,147 @@ async def get_source_gpx_info(filename: str) -> Dict[str, any]:
         return {"error": f"Error parsing GPX file: {str(e)}"}
 
 
+async def get_source_gpx_info(
+    filename: str,
+    executor: Optional[Executor] = None
+) -> Dict[str, any]:
+    """
+    Get information about a source GPX file
+    
+    Args:
+        filename: Name of the GPX file in the source GPX directory
+        executor: Executor to parse in (the default thread pool if not given)
+        
+    Returns:
+        Dictionary with GPX information
+    """
+    success, content = await load_source_gpx_file(filename)
+    
+    if not success:
+        return {"error": content}
+    
+    # Parse off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, parse_gpx_info, filename, content)
+
+
+async def get_source_gpx_infos(filenames: List[str]) -> List[Dict[str, any]]:
+    """
+    Get information about several source GPX files, parsing them in parallel processes
+    
+    Args:
+        filenames: Names of the GPX files in the source GPX directory
+        
+    Returns:
+        List of GPX information dictionaries in the same order
+    """
+    if not filenames:
+        return []
+    
+    with ProcessPoolExecutor(max_workers=min(len(filenames), os.cpu_count() or 1)) as executor:
+        return await asyncio.gather(
+            *[get_source_gpx_info(filename, executor) for filename in filenames]
+        )
+
+
+def source_route_path(gpx_path: Path) -> Path:
+    """
+    Path of the precomputed route file stored next to a source GPX file
+    """
+    return gpx_path.with_suffix(".npz")
+
+
+def build_source_route_file(gpx_path: Path) -> SourceRoute:
+    """
+    Parse and simplify a source GPX file and save the result next to it.
+    Kept at module level so it can run in a worker process.
+    
+    Args:
+        gpx_path: Path of the GPX file
+        
+    Returns:
+        Prepared SourceRoute
+    """
+    with open(gpx_path, "r") as f:
+        source_route = prepare_source_route(f.read())
+    
+    # A read-only source directory only costs the precomputation on the next load
+    try:
+        save_source_route(source_route, source_route_path(gpx_path))
+    except OSError as e:
+        print(f"Error saving source route for {gpx_path.name}: {e}")
+    
+    return source_route
+
+
+def read_source_route_file(gpx_path: Path) -> SourceRoute:
+    """
+    Read the precomputed route of a source GPX file, rebuilding it if it is
+    missing, older than the GPX file or saved by another format version
+    
+    Args:
+        gpx_path: Path of the GPX file
+        
+    Returns:
+        Prepared SourceRoute
+    """
+    route_path = source_route_path(gpx_path)
+    try:
+        if route_path.stat().st_mtime >= gpx_path.stat().st_mtime:
+            source_route = load_source_route(route_path)
+            if source_route is not None:
+                return source_route
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error reading source route for {gpx_path.name}: {e}")
+    
+    return build_source_route_file(gpx_path)
+
+
+async def get_source_route_from_file(filename: str) -> Tuple[bool, Union[SourceRoute, str]]:
+    """
+    Get the prepared route of a source GPX file, using the precomputed route file
+    
+    Args:
+        filename: Name of the GPX file in the source GPX directory
+        
+    Returns:
+        Tuple of (success, SourceRoute or error message)
+    """
+    gpx_path = Path(settings.SOURCE_GPX_PATH) / filename
+    try:
+        loop = asyncio.get_running_loop()
+        return True, await loop.run_in_executor(None, read_source_route_file, gpx_path)
+    except FileNotFoundError:
+        return False, f"File {filename} not found"
+    except Exception as e:
+        return False, f"Error loading source GPX: {str(e)}"
+
+
+async def precompute_source_routes(filenames: List[str]) -> None:
+    """
+    Build the precomputed route files of several source GPX files in parallel processes
+    
+    Args:
+        filenames: Names of the GPX files in the source GPX directory
+    """
+    if not filenames:
+        return
+    
+    source_dir = Path(settings.SOURCE_GPX_PATH)
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=min(len(filenames), os.cpu_count() or 1)) as executor:
+        results = await asyncio.gather(
+            *[loop.run_in_executor(executor, build_source_route_file, source_dir / filename) for filename in filenames],
+            return_exceptions=True
+        )
+    
+    for filename, result in zip(filenames, results):
+        if isinstance(result, Exception):
+            print(f"Error precomputing source route for {filename}: {result}")
+
+
 async def list_available_source_gpx_files() -> List[str]:
     """
     List all available GPX files in the source directory
@@ -95,13 +252,15 @@ async def list_available_source_gpx_files() -> List[str]:
     """
     try:
         source_dir = Path(settings.SOURCE_GPX_PATH)
-        return [f.name for f in source_dir.glob("*.gpx")]
+        # Enumerate the directory in a thread, so the event loop isn't blocked
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: [f.name for f in source_dir.glob("*.gpx")])
     except Exception as e:
         print(f"Error listing GPX files: {e}")
         return []
 
 
-async def init_source_gpx_database(db: Session) -> None:
+async def init_source_gpx_database(db: AsyncSession) -> None:
     """
     Initialize source GPX database from files
     
@@ -111,32 +270,45 @@ async def init_source_gpx_database(db: Session) -> None:
     # List available GPX files
     files = await list_available_source_gpx_files()
     
-    for filename in files:
-        # Check if already in database
-        existing = db.query(models.SourceGPX).filter(models.SourceGPX.filename == filename).first()
-        if existing:
-            continue
-            
-        # Get info for new file
-        info = await get_source_gpx_info(filename)
+    # Look up which files are already in the database at once
+    result = await db.execute(
+        select(models.SourceGPX.filename).filter(models.SourceGPX.filename.in_(files))
+    )
+    existing = set(result.scalars().all())
+    
+    # Get info for all new files in parallel
+    new_files = [filename for filename in files if filename not in existing]
+    infos = await get_source_gpx_infos(new_files)
+    
+    new_rows = []
+    for filename, info in zip(new_files, infos):
         if "error" in info:
             print(f"Error processing {filename}: {info['error']}")
             continue
             
         # Add to database
-        new_source = models.SourceGPX(
-            name=info.get("name", "Unnamed Route"),
-            description=info.get("description", ""),
-            filename=filename,
-            distance=info.get("distance_meters", 0)
+        new_rows.append({
+            "name": info.get("name", "Unnamed Route"),
+            "description": info.get("description", ""),
+            "filename": filename,
+            "distance": info.get("distance_meters", 0)
+        })
+    
+    # Insert all new routes in a single statement; every app worker runs this on
+    # startup, so skip files another one inserted since the lookup
+    if new_rows:
+        await db.execute(
+            pg_insert(models.SourceGPX).on_conflict_do_nothing(index_elements=["filename"]),
+            new_rows
         )
-        
-        db.add(new_source)
     
-    db.commit()
+    await db.commit()
+    
+    # Simplify the new routes now instead of on the first verification
+    await precompute_source_routes([row["filename"] for row in new_rows])
 
 
-async def get_all_source_gpxs(db: Session) -> List[models.SourceGPX]:
+async def get_all_source_gpxs(db: AsyncSession) -> List[models.SourceGPX]:
     """
     Get all source GPX routes from database
     
@@ -146,10 +318,11 @@ async def get_all_source_gpxs(db: Session) -> List[models.SourceGPX]:
     Returns:
         List of SourceGPX models
     """
-    return db.query(models.SourceGPX).filter(models.SourceGPX.is_active == True).all()
+    result = await db.execute(select(models.SourceGPX).filter(models.SourceGPX.is_active == True))
+    return result.scalars().all()
 
 
-async def get_source_gpx_by_id(db: Session, source_id: str) -> Optional[models.SourceGPX]:
+async def get_source_gpx_by_id(db: AsyncSession, source_id: str) -> Optional[models.SourceGPX]:
     """
     Get source GPX by ID
     
@@ -160,7 +333,10 @@ async def get_source_gpx_by_id(db: Session, source_id: str) -> Optional[models.S
     Returns:
         SourceGPX model or None
     """
-    return db.query(models.SourceGPX).filter(
-        models.SourceGPX.id == source_id,
-        models.SourceGPX.is_active == True
-    ).first()
\ No newline at end of file
+    result = await db.execute(
+        select(models.SourceGPX).filter(
+            models.SourceGPX.id == source_id,
+            models.SourceGPX.is_active == True
+        )
+    )
+    return result.scalars().first()
\ No newline at end of file
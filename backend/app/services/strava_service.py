@@ -1,13 +1,82 @@
+import asyncio
+import logging
 import time
 from datetime import datetime
 from typing import Any, Dict, List, Optional, Tuple
 
 import httpx
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .. import models
 from ..core.config import settings
 
+logger = logging.getLogger("strava_service")
+
+# Shared client so Strava requests reuse keep-alive connections instead of a new TLS handshake each time
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Get the shared Strava HTTP client, creating it on first use.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=True,  # Concurrent requests share one multiplexed connection
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            timeout=httpx.Timeout(10.0)
+        )
+    return _http_client
+
+
+def _daily_limit_reached(response: httpx.Response) -> bool:
+    """
+    Check the rate limit headers ("15-minute,daily") for an exhausted daily quota
+    """
+    try:
+        usage = int(response.headers["X-RateLimit-Usage"].split(",")[1])
+        limit = int(response.headers["X-RateLimit-Limit"].split(",")[1])
+    except (KeyError, IndexError, ValueError):
+        return False
+    return usage >= limit
+
+
+async def _strava_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Send a request with the shared client, backing off when Strava rate-limits it
+    
+    Args:
+        method: HTTP method
+        url: Request URL
+        **kwargs: Arguments passed on to httpx
+        
+    Returns:
+        The last response, which is still 429 if all retries were rate-limited
+    """
+    client = get_http_client()
+    for attempt in range(settings.STRAVA_MAX_RETRIES + 1):
+        response = await client.request(method, url, **kwargs)
+        # Retrying can't help once the daily quota is used up
+        if response.status_code != 429 or attempt == settings.STRAVA_MAX_RETRIES or _daily_limit_reached(response):
+            return response
+        
+        delay = settings.STRAVA_RETRY_BACKOFF_SECONDS * 2 ** attempt
+        logger.warning("Strava rate limit hit for %s, retrying in %.1fs", url, delay)
+        await asyncio.sleep(delay)
+    return response
+
+
+async def close_http_client() -> None:
+    """
+    Close the shared Strava HTTP client and its connections.
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
 
 async def exchange_authorization_code(
     code: str, 
@@ -44,16 +113,15 @@ async def exchange_authorization_code(
     }
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, data=data)
-            print(f"Response status: {response.status_code}")
-            
-            if response.status_code != 200:
-                error_text = response.text
-                print(f"Error from Strava: {error_text}")
-                return {"error": f"Strava API error: {response.status_code}"}
-            
-            return response.json()
+        response = await _strava_request("POST", url, data=data, timeout=30.0)
+        print(f"Response status: {response.status_code}")
+        
+        if response.status_code != 200:
+            error_text = response.text
+            print(f"Error from Strava: {error_text}")
+            return {"error": f"Strava API error: {response.status_code}"}
+        
+        return response.json()
     except Exception as e:
         print(f"Error exchanging code: {str(e)}")
         return {"error": str(e)}
@@ -78,9 +146,8 @@ async def refresh_access_token(refresh_token: str) -> Dict[str, Any]:
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, data=data)
-            return response.json()
+        response = await _strava_request("POST", url, data=data)
+        return response.json()
     except Exception as e:
         print(f"Error refreshing access token: {e}")
         return {"error": str(e)}
@@ -100,9 +167,8 @@ async def get_strava_athlete_data(access_token: str) -> Dict[str, Any]:
     headers = {"Authorization": f"Bearer {access_token}"}
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers)
-            return response.json()
+        response = await _strava_request("GET", url, headers=headers)
+        return response.json()
     except Exception as e:
         print(f"Error getting athlete data: {e}")
         return {"error": str(e)}
@@ -137,14 +203,13 @@ async def get_activities_after_date(
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, params=params)
-            activities = response.json()
-            
-            # Filter activities by type
-            if activities and isinstance(activities, list):
-                return [a for a in activities if a.get("type") == activity_type]
-            return []
+        response = await _strava_request("GET", url, headers=headers, params=params)
+        activities = response.json()
+        
+        # Filter activities by type
+        if activities and isinstance(activities, list):
+            return [a for a in activities if a.get("type") == activity_type]
+        return []
     except Exception as e:
         print(f"Error getting activities: {e}")
         return []
@@ -169,9 +234,8 @@ async def get_activity_by_id(
     params = {"include_all_efforts": False}
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, params=params)
-            return response.json()
+        response = await _strava_request("GET", url, headers=headers, params=params)
+        return response.json()
     except Exception as e:
         print(f"Error getting activity details: {e}")
         return {"error": str(e)}
@@ -199,9 +263,8 @@ async def get_activity_streams(
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, params=params)
-            return response.json()
+        response = await _strava_request("GET", url, headers=headers, params=params)
+        return response.json()
     except Exception as e:
         print(f"Error getting activity streams: {e}")
         return {"error": str(e)}
@@ -244,7 +307,7 @@ async def create_strava_auth_url(
     return auth_url
 
 
-async def ensure_fresh_token(db: Session, user_id: str) -> Tuple[bool, str]:
+async def ensure_fresh_token(db: AsyncSession, user_id: str) -> Tuple[bool, str]:
     """
     Ensure the user has a fresh Strava access token
     
@@ -256,7 +319,8 @@ async def ensure_fresh_token(db: Session, user_id: str) -> Tuple[bool, str]:
         Tuple of (success, access_token)
     """
     # Get token from database
-    token = db.query(models.Token).filter(models.Token.user_id == user_id).first()
+    result = await db.execute(select(models.Token).filter(models.Token.user_id == user_id))
+    token = result.scalars().first()
     
     if not token:
         return False, "No token found"
@@ -265,21 +329,42 @@ async def ensure_fresh_token(db: Session, user_id: str) -> Tuple[bool, str]:
     
     # Check if token is expired or about to expire (within 5 minutes)
     if token.expires_at <= current_time + 300:
+        # Lock the row and read it again; Strava rotates refresh tokens, so another
+        # process may have refreshed it already and the old one would be rejected
+        result = await db.execute(
+            select(models.Token)
+            .filter(models.Token.id == token.id)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )
+        token = result.scalars().first()
+        if token.expires_at > current_time + 300:
+            await db.commit()
+            return True, token.access_token
+        
         # Refresh the token
         token_response = await refresh_access_token(token.refresh_token)
         
         if "error" in token_response:
+            await db.rollback()
             return False, token_response["error"]
         
         # Update token in database
-        token.access_token = token_response["access_token"]
-        token.refresh_token = token_response["refresh_token"]
-        token.expires_at = token_response["expires_at"]
-        token.updated_at = datetime.now()
+        _apply_token_response(token, token_response)
         
-        db.commit()
+        await db.commit()
         
         return True, token.access_token
     
     # Token is still valid
-    return True, token.access_token
\ No newline at end of file
+    return True, token.access_token
+
+
+def _apply_token_response(token: models.Token, token_response: Dict[str, Any]) -> None:
+    """
+    Store a refreshed token response on a token row
+    """
+    token.access_token = token_response["access_token"]
+    token.refresh_token = token_response["refresh_token"]
+    token.expires_at = token_response["expires_at"]
+    token.updated_at = datetime.now()
@@ -14,6 +14,7 @@ Options:
 """
 
 import argparse
+import asyncio
 import os
 import sys
 from pathlib import Path
@@ -21,6 +22,8 @@ from pathlib import Path
 # Add parent directory to path to import from app
 sys.path.append(str(Path(__file__).parent.parent))
 
+from sqlalchemy import delete, func, literal, select, text, union_all
+
 # Import database models and configuration from your application
 from app.database import SessionLocal, Base, engine
 from app.models import User, Activity, ActivityAttempt, Token, SourceGPX, Leaderboard, VerificationToken, AuditLog
@@ -34,11 +37,21 @@ def print_separator():
     """Print a separator line"""
     print("-" * 50)
 
-def get_table_count(db, model):
+async def get_table_count(db, model):
     """Get the count of rows in a table"""
-    return db.query(model).count()
+    result = await db.execute(select(func.count()).select_from(model))
+    return result.scalar_one()
+
+async def get_table_counts(db, models):
+    """Get the row counts of several tables in a single query"""
+    result = await db.execute(union_all(*[
+        select(literal(i).label("position"), func.count().label("count")).select_from(model)
+        for i, model in enumerate(models)
+    ]))
+    counts = dict(result.all())
+    return [counts[i] for i in range(len(models))]
 
-def print_table_counts(db):
+async def print_table_counts(db):
     """Print the number of rows in each table"""
     print_separator()
     print("CURRENT DATABASE STATE:")
@@ -55,27 +68,27 @@ def print_table_counts(db):
         ("Audit Logs", AuditLog)
     ]
     
-    for name, model in tables:
-        count = get_table_count(db, model)
+    counts = await get_table_counts(db, [model for _, model in tables])
+    for (name, _), count in zip(tables, counts):
         print(f"{name}: {count} rows")
     
     print_separator()
 
-def clean_table(db, model, name):
+async def clean_table(db, model, name):
     """Clean a specific table"""
     try:
-        count_before = get_table_count(db, model)
+        count_before = await get_table_count(db, model)
         # Delete all rows in the table
-        db.query(model).delete()
-        db.commit()
+        await db.execute(delete(model))
+        await db.commit()
         print(f"✓ Cleared {count_before} rows from {name}")
         return True
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"✗ Error clearing {name}: {str(e)}")
         return False
 
-def clean_all_tables(db, confirm=False):
+async def clean_all_tables(db, confirm=False):
     """Clean all tables in the database"""
     if not confirm:
         print("WARNING: This will delete ALL data from your database!")
@@ -100,10 +113,20 @@ def clean_all_tables(db, confirm=False):
     print("CLEANING TABLES:")
     print_separator()
     
+    # Truncate all tables in one statement instead of deleting row by row; the set
+    # includes every table referencing users, so no CASCADE is needed
     success = True
-    for name, model in tables:
-        if not clean_table(db, model, name):
-            success = False
+    try:
+        counts = await get_table_counts(db, [model for _, model in tables])
+        table_names = ", ".join(model.__tablename__ for _, model in tables)
+        await db.execute(text(f"TRUNCATE TABLE {table_names}"))
+        await db.commit()
+        for (name, _), count in zip(tables, counts):
+            print(f"✓ Cleared {count} rows from {name}")
+    except Exception as e:
+        await db.rollback()
+        print(f"✗ Error clearing tables: {str(e)}")
+        success = False
     
     if success:
         print_separator()
@@ -113,9 +136,9 @@ def clean_all_tables(db, confirm=False):
         print("⚠ Database cleanup completed with errors")
     
     # Print the current state after cleanup
-    print_table_counts(db)
+    await print_table_counts(db)
 
-def clean_specific_table(db, table_name, confirm=False):
+async def clean_specific_table(db, table_name, confirm=False):
     """Clean a specific table by name"""
     # Map table names to models
     table_map = {
@@ -151,7 +174,7 @@ def clean_specific_table(db, table_name, confirm=False):
     print(f"CLEANING TABLE: {display_name}")
     print_separator()
     
-    return clean_table(db, model, display_name)
+    return await clean_table(db, model, display_name)
 
 def main():
     parser = argparse.ArgumentParser(description="Clean up database tables")
@@ -161,26 +184,28 @@ def main():
     
     args = parser.parse_args()
     
+    asyncio.run(run(parser, args))
+
+async def run(parser, args):
+    """Run the requested cleanup with an async database session"""
     # Create a database session
-    db = SessionLocal()
-    
-    try:
+    async with SessionLocal() as db:
         # Print current table counts
-        print_table_counts(db)
+        await print_table_counts(db)
         
         if args.all:
             # Clean all tables
-            clean_all_tables(db, args.confirm)
+            await clean_all_tables(db, args.confirm)
         elif args.table:
             # Clean specific tables
             for table_name in args.table:
-                clean_specific_table(db, table_name, args.confirm)
+                await clean_specific_table(db, table_name, args.confirm)
         else:
             # No action specified, show help
             parser.print_help()
-    finally:
-        # Close the database session
-        db.close()
+    
+    # Release pooled connections before the event loop closes
+    await engine.dispose()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
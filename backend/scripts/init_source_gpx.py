@@ -22,9 +22,15 @@ from pathlib import Path
 # Add the parent directory to sys.path to import app modules
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
-from app.database import SessionLocal
+from sqlalchemy import insert, select, update
+
+from app.database import SessionLocal, engine
 from app.models import SourceGPX
-from app.services.source_gpx_service import get_source_gpx_info, list_available_source_gpx_files
+from app.services.source_gpx_service import (
+    get_source_gpx_infos,
+    list_available_source_gpx_files,
+    precompute_source_routes
+)
 from app.core.config import settings
 
 async def init_source_gpx_database(force=False):
@@ -49,17 +55,27 @@ async def init_source_gpx_database(force=False):
             print(f"Please add GPX files to this directory and run the script again.")
             return
         
+        # Look up all existing entries at once
+        result = await db.execute(select(SourceGPX.filename, SourceGPX.id).filter(SourceGPX.filename.in_(files)))
+        existing_ids = dict(result.all())
+        
+        # Rows to insert and update, each written in a single statement below
+        new_rows = []
+        updated_rows = []
+        
+        to_process = []
         for filename in files:
-            # Check if already in database
-            existing = db.query(SourceGPX).filter(SourceGPX.filename == filename).first()
-            
-            if existing and not force:
+            if filename in existing_ids and not force:
                 print(f"Skipping {filename} - already in database (use --force to update)")
                 continue
-                
-            # Get info for new file
-            print(f"Processing {filename}...")
-            info = await get_source_gpx_info(filename)
+            to_process.append(filename)
+            
+        # Get info for all files to process in parallel
+        print(f"Processing {', '.join(to_process) or 'no files'}...")
+        infos = await get_source_gpx_infos(to_process)
+        
+        for filename, info in zip(to_process, infos):
+            existing = existing_ids.get(filename)
             
             if "error" in info:
                 print(f"Error processing {filename}: {info['error']}")
@@ -68,32 +84,46 @@ async def init_source_gpx_database(force=False):
             if existing and force:
                 # Update existing record
                 print(f"Updating existing entry for {filename}")
-                existing.name = info.get("name", "Unnamed Route")
-                existing.description = info.get("description", "")
-                existing.distance = info.get("distance_meters", 0)
-                existing.is_active = True
-                existing.updated_at = datetime.now()
+                updated_rows.append({
+                    "id": existing,
+                    "name": info.get("name", "Unnamed Route"),
+                    "description": info.get("description", ""),
+                    "distance": info.get("distance_meters", 0),
+                    "is_active": True,
+                    "updated_at": datetime.now()
+                })
             else:
                 # Add new record
                 print(f"Adding new entry for {filename}")
-                new_source = SourceGPX(
-                    id=uuid.uuid4(),
-                    name=info.get("name", "Unnamed Route"),
-                    description=info.get("description", ""),
-                    filename=filename,
-                    distance=info.get("distance_meters", 0),
-                    is_active=True,
-                    created_at=datetime.now(),
-                    updated_at=datetime.now()
-                )
-                db.add(new_source)
+                new_rows.append({
+                    "id": uuid.uuid4(),
+                    "name": info.get("name", "Unnamed Route"),
+                    "description": info.get("description", ""),
+                    "filename": filename,
+                    "distance": info.get("distance_meters", 0),
+                    "is_active": True,
+                    "created_at": datetime.now(),
+                    "updated_at": datetime.now()
+                })
+        
+        if new_rows:
+            await db.execute(insert(SourceGPX), new_rows)
+        if updated_rows:
+            # Bulk UPDATE matched by primary key
+            await db.execute(update(SourceGPX), updated_rows)
             
         # Commit changes
-        db.commit()
+        await db.commit()
+        
+        # Rebuild the precomputed routes of the processed files
+        await precompute_source_routes([row["filename"] for row in new_rows] + [
+            filename for filename in to_process if existing_ids.get(filename) and force
+        ])
         print("Database initialization complete!")
         
         # Print summary of source GPXs in database
-        sources = db.query(SourceGPX).all()
+        result = await db.execute(select(SourceGPX))
+        sources = result.scalars().all()
         print(f"\nSource GPXs in database ({len(sources)}):")
         for source in sources:
             print(f"  - {source.name} ({source.filename}): {source.distance/1000:.1f}km, Active: {source.is_active}")
@@ -101,7 +131,8 @@ async def init_source_gpx_database(force=False):
     except Exception as e:
         print(f"Error initializing database: {e}")
     finally:
-        db.close()
+        await db.close()
+        await engine.dispose()
 
 def main():
     parser = argparse.ArgumentParser(description="Initialize source GPX files in the database")
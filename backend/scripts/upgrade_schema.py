@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# backend/scripts/upgrade_schema.py
+"""
+Script to bring an existing database up to the current models.
+The API does this on startup unless CREATE_TABLES_ON_STARTUP is false;
+run this script after updating a deployment with startup creation disabled.
+
+Usage:
+    python upgrade_schema.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+# Add the parent directory to sys.path to import app modules
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from app.database import engine
+from app.schema import upgrade_schema
+
+async def main():
+    """
+    Create missing tables, columns and indexes in one transaction
+    """
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(upgrade_schema)
+        print("Database schema is up to date")
+    finally:
+        await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,9 +5,17 @@ from sqlalchemy.orm import relationship, sessionmaker
 
 from settings import settings
 
-# Create database engine and session
-engine = create_engine(settings.DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Create database engine and session; connections sit idle between scheduled jobs,
+# so they are checked before use and replaced periodically
+engine = create_engine(
+    settings.DATABASE_URL,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+)
+# Objects stay loaded after commit, so the worker doesn't re-query rows it just wrote
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 # Base class for declarative models
 Base = declarative_base()
@@ -23,6 +31,8 @@ class User(Base):
     
     # Strava information
     strava_id = Column(String, unique=True, index=True, nullable=True)
+    strava_ride_count = Column(Integer, nullable=True)  # Strava's ride total at the last activity check
+    strava_activities_etag = Column(String, nullable=True)  # ETag of the activity list at the last activity check
     
     # Status flags
     is_active = Column(Boolean, default=True)
@@ -1,20 +1,28 @@
 # worker/services.py
+import asyncio
+import io
 import logging
 import math
+import os
 import smtplib
 import ssl
+import threading
 import time
 import uuid
+from dataclasses import dataclass
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Any
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple, Union, Any
+from xml.etree import ElementTree
 
-import gpxpy
-import gpxpy.gpx
 import httpx
-from shapely.geometry import LineString, Point
+import numpy as np
+import orjson
+from shapely.geometry import LineString
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
 from models import User, Activity, ActivityAttempt, Token, SourceGPX, Leaderboard
@@ -24,6 +32,86 @@ from settings import settings
 logger = logging.getLogger("kmtb-worker")
 
 # Email service functions
+SMTP_IDLE_SECONDS = 60  # Reconnect rather than reuse a connection idle this long; servers drop them
+
+# Secure SSL context, built once since loading the trust store is costly
+_ssl_context = ssl.create_default_context()
+
+class SmtpSender:
+    """One SMTP connection reused for several messages, reconnecting when it went idle or dropped;
+    safe to share between threads, which take turns on the connection"""
+    
+    def __init__(self) -> None:
+        self._server: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+    
+    def __enter__(self) -> "SmtpSender":
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+    
+    def _connect(self) -> smtplib.SMTP:
+        """Open and authenticate a new SMTP connection for the configured port"""
+        if settings.SMTP_PORT == 1025:  # For Mailpit testing (no auth, no SSL/TLS)
+            return smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT)
+        
+        if settings.SMTP_PORT == 465:  # For SSL connections
+            server = smtplib.SMTP_SSL(settings.SMTP_SERVER, settings.SMTP_PORT, context=_ssl_context)
+        else:  # For TLS connections (usually port 587)
+            server = smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT)
+            server.ehlo()
+            server.starttls(context=_ssl_context)
+            server.ehlo()
+        if settings.SMTP_USERNAME and settings.SMTP_PASSWORD:
+            server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
+        return server
+    
+    def send(self, recipients: List[str], message: str) -> None:
+        """Send a message, opening a connection first if needed"""
+        with self._lock:
+            if self._server is not None and time.monotonic() - self._last_used > SMTP_IDLE_SECONDS:
+                self._close()
+            
+            for attempt in range(2):
+                if self._server is None:
+                    self._server = self._connect()
+                try:
+                    self._server.sendmail(settings.SMTP_FROM, recipients, message)
+                    self._last_used = time.monotonic()
+                    return
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    # A reused connection was closed by the server; retry once on a new one
+                    self._close()
+                    if attempt:
+                        raise
+                except Exception:
+                    self._close()
+                    raise
+    
+    def close(self) -> None:
+        """Close the connection, ignoring errors from already broken ones"""
+        with self._lock:
+            self._close()
+    
+    def _close(self) -> None:
+        """Close the connection; the caller holds the lock"""
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            self._server.close()
+        self._server = None
+
+# Shared sender, so the verification emails of a job reuse one connection
+_smtp_sender = SmtpSender()
+
+def close_email_connection() -> None:
+    """Close the shared SMTP connection"""
+    _smtp_sender.close()
+
 def send_email(
     to_email: str,
     subject: str,
@@ -53,27 +141,9 @@ def send_email(
     html_part = MIMEText(html_content, "html")
     msg.attach(html_part)
     
-    # Create secure SSL context
-    context = ssl.create_default_context()
-    
     try:
-        # Connect to server and send email
-        if settings.SMTP_PORT == 1025:  # For Mailpit testing (no auth, no SSL/TLS)
-            with smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT) as server:
-                server.sendmail(settings.SMTP_FROM, recipients, msg.as_string())
-        elif settings.SMTP_PORT == 465:  # For SSL connections
-            with smtplib.SMTP_SSL(settings.SMTP_SERVER, settings.SMTP_PORT, context=context) as server:
-                if settings.SMTP_USERNAME and settings.SMTP_PASSWORD:
-                    server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
-                server.sendmail(settings.SMTP_FROM, recipients, msg.as_string())
-        else:  # For TLS connections (usually port 587)
-            with smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT) as server:
-                server.ehlo()
-                server.starttls(context=context)
-                server.ehlo()
-                if settings.SMTP_USERNAME and settings.SMTP_PASSWORD:
-                    server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
-                server.sendmail(settings.SMTP_FROM, recipients, msg.as_string())
+        # Send over the shared connection
+        _smtp_sender.send(recipients, msg.as_string())
         
         logger.info(f"Email sent successfully to {to_email}")
         return True
@@ -108,6 +178,117 @@ def send_activity_verification_email(
     return send_email(to_email, subject, content)
 
 # Strava API functions
+
+# Shared client so Strava requests reuse keep-alive connections instead of a new TLS handshake each time
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get the shared Strava HTTP client, creating it on first use"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            # Concurrent requests share one multiplexed connection; failed connects are retried
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                retries=2
+            ),
+            timeout=30.0,
+            event_hooks={"response": [_record_rate_limit]}
+        )
+    return _http_client
+
+async def close_http_client() -> None:
+    """Close the shared Strava HTTP client and its connections"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+STRAVA_MAX_RETRIES = 3  # Retries of a rate-limited (429) request
+STRAVA_SHORT_WINDOW_SECONDS = 15 * 60  # Strava's short-term limit resets every quarter hour
+STRAVA_DAILY_WINDOW_SECONDS = 24 * 60 * 60  # and the daily limit at midnight UTC
+
+def _next_window(now: float, period: int) -> float:
+    """Start of the next rate limit window, aligned to the epoch like Strava's"""
+    return (now // period + 1) * period
+
+@dataclass
+class RateLimitState:
+    """Strava rate limit usage, updated from the headers of every response"""
+    short_usage: int = 0
+    short_limit: Optional[int] = None
+    daily_usage: int = 0
+    daily_limit: Optional[int] = None
+    short_reset_at: float = 0.0
+    daily_reset_at: float = 0.0
+    
+    def _roll_windows(self, now: float) -> None:
+        """Clear the usage of windows that have ended"""
+        if now >= self.short_reset_at:
+            self.short_usage = 0
+            self.short_reset_at = _next_window(now, STRAVA_SHORT_WINDOW_SECONDS)
+        if now >= self.daily_reset_at:
+            self.daily_usage = 0
+            self.daily_reset_at = _next_window(now, STRAVA_DAILY_WINDOW_SECONDS)
+    
+    def update(self, response: httpx.Response) -> None:
+        """Take usage and limits from the X-RateLimit headers ("15-minute,daily")"""
+        try:
+            short_limit, daily_limit = map(int, response.headers["X-RateLimit-Limit"].split(","))
+            short_usage, daily_usage = map(int, response.headers["X-RateLimit-Usage"].split(","))
+        except (KeyError, ValueError):
+            return
+        self._roll_windows(time.time())
+        self.short_limit, self.daily_limit = short_limit, daily_limit
+        self.short_usage, self.daily_usage = short_usage, daily_usage
+    
+    def short_remaining(self) -> Optional[int]:
+        """Requests left in the current 15-minute window, if the limit is known"""
+        if self.short_limit is None:
+            return None
+        return max(0, self.short_limit - self.short_usage)
+    
+    async def acquire(self) -> None:
+        """Wait until both windows have budget left, then count one request against them"""
+        while True:
+            now = time.time()
+            self._roll_windows(now)
+            if self.daily_limit is not None and self.daily_usage >= self.daily_limit:
+                wait_until = self.daily_reset_at
+            elif self.short_limit is not None and self.short_usage >= self.short_limit:
+                wait_until = self.short_reset_at
+            else:
+                # Counted before sending, so concurrent requests don't all see the same budget
+                self.short_usage += 1
+                self.daily_usage += 1
+                return
+            
+            logger.warning(f"Strava rate limit used up, waiting {wait_until - now:.0f}s for the next window")
+            await asyncio.sleep(wait_until - now)
+
+_rate_limit = RateLimitState()
+
+async def _record_rate_limit(response: httpx.Response) -> None:
+    """Response hook keeping the shared rate limit state current"""
+    _rate_limit.update(response)
+
+async def _strava_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Send a request with the shared client within Strava's rate limits, retrying 429 responses"""
+    client = get_http_client()
+    for attempt in range(STRAVA_MAX_RETRIES + 1):
+        await _rate_limit.acquire()
+        response = await client.request(method, url, **kwargs)
+        if response.status_code != 429 or attempt == STRAVA_MAX_RETRIES:
+            return response
+        
+        # Honor Retry-After when given; otherwise acquire() waits for the window to reset
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            logger.warning(f"Strava rate limit hit for {url}, retrying in {retry_after}s")
+            await asyncio.sleep(int(retry_after))
+    return response
+
 async def refresh_access_token(refresh_token: str) -> Dict[str, Any]:
     """Refresh Strava access token using refresh token"""
     url = "https://www.strava.com/oauth/token"
@@ -119,54 +300,128 @@ async def refresh_access_token(refresh_token: str) -> Dict[str, Any]:
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, data=data)
-            return response.json()
+        response = await get_http_client().post(url, data=data)
+        return orjson.loads(response.content)
     except Exception as e:
         logger.error(f"Error refreshing access token: {e}")
         return {"error": str(e)}
 
+# Access tokens by user ID with their expiry, kept for the life of the worker
+# process so checks of a user's activities don't query the token every time
+_token_cache: Dict[str, Tuple[str, int]] = {}
+TOKEN_EXPIRY_MARGIN_SECONDS = 300  # Refresh tokens expiring within 5 minutes
+TOKEN_PREFETCH_SECONDS = 600  # Refresh ahead of a job tokens expiring within 10 minutes
+TOKEN_REFRESH_CONCURRENCY = 10  # Most token refreshes sent to Strava at once
+
+def _apply_token_response(token: Token, token_response: Dict[str, Any]) -> None:
+    """Store a refreshed token in its row and the cache"""
+    token.access_token = token_response["access_token"]
+    token.refresh_token = token_response["refresh_token"]
+    token.expires_at = token_response["expires_at"]
+    token.updated_at = datetime.now()
+    _token_cache[str(token.user_id)] = (token.access_token, token.expires_at)
+
 async def ensure_fresh_token(db: Session, user_id: str) -> Tuple[bool, str]:
     """Ensure the user has a fresh Strava access token"""
+    current_time = int(time.time())
+    
+    # Use the cached token while it is valid beyond the refresh margin
+    cached = _token_cache.get(str(user_id))
+    if cached and cached[1] > current_time + TOKEN_EXPIRY_MARGIN_SECONDS:
+        return True, cached[0]
+    
     # Get token from database
     token = db.query(Token).filter(Token.user_id == user_id).first()
     
     if not token:
         return False, "No token found"
     
-    current_time = int(time.time())
-    
     # Check if token is expired or about to expire (within 5 minutes)
-    if token.expires_at <= current_time + 300:
+    if token.expires_at <= current_time + TOKEN_EXPIRY_MARGIN_SECONDS:
+        # Lock the row and read it again; Strava rotates refresh tokens, so the
+        # backend may have refreshed it already and the old one would be rejected
+        token = db.query(Token).filter(Token.id == token.id).with_for_update().populate_existing().first()
+        if token.expires_at > current_time + TOKEN_EXPIRY_MARGIN_SECONDS:
+            db.commit()
+            _token_cache[str(user_id)] = (token.access_token, token.expires_at)
+            return True, token.access_token
+        
         # Refresh the token
         token_response = await refresh_access_token(token.refresh_token)
         
         if "error" in token_response:
+            db.rollback()
             return False, token_response["error"]
         
         # Update token in database
-        token.access_token = token_response["access_token"]
-        token.refresh_token = token_response["refresh_token"]
-        token.expires_at = token_response["expires_at"]
-        token.updated_at = datetime.now()
+        _apply_token_response(token, token_response)
         
         db.commit()
         
         return True, token.access_token
     
     # Token is still valid
+    _token_cache[str(user_id)] = (token.access_token, token.expires_at)
     return True, token.access_token
 
-async def get_activities_after_date(
-    access_token: str, 
+async def refresh_expiring_tokens(db: Session, user_ids: List[str]) -> None:
+    """Load the given users' tokens into the cache ahead of a job, refreshing the ones about to expire"""
+    if not user_ids:
+        return
+    
+    expiring_before = int(time.time()) + TOKEN_PREFETCH_SECONDS
+    tokens = db.query(Token).filter(
+        Token.user_id.in_(user_ids),
+        Token.expires_at > expiring_before
+    ).all()
+    
+    for token in tokens:
+        _token_cache[str(token.user_id)] = (token.access_token, token.expires_at)
+    
+    # Lock the expiring rows, skipping ones another session is refreshing right now
+    expiring = db.query(Token).filter(
+        Token.user_id.in_(user_ids),
+        Token.expires_at <= expiring_before
+    ).with_for_update(skip_locked=True).populate_existing().all()
+    
+    if not expiring:
+        db.rollback()
+        return
+    
+    # Refresh concurrently, a few at a time; failures are left for ensure_fresh_token to retry and report
+    semaphore = asyncio.Semaphore(TOKEN_REFRESH_CONCURRENCY)
+    
+    async def refresh(token: Token) -> Dict[str, Any]:
+        async with semaphore:
+            return await refresh_access_token(token.refresh_token)
+    
+    responses = await asyncio.gather(*[refresh(token) for token in expiring])
+    refreshed = 0
+    for token, token_response in zip(expiring, responses):
+        if "access_token" not in token_response:
+            logger.warning(f"Failed to refresh token for user {token.user_id}: {token_response}")
+            continue
+        _apply_token_response(token, token_response)
+        refreshed += 1
+    
+    db.commit()
+    logger.info(f"Refreshed {refreshed} of {len(expiring)} expiring tokens")
+
+STRAVA_MAX_PER_PAGE = 200  # Largest page Strava's activity list returns
+STRAVA_PAGE_CONCURRENCY = 4  # Most activity pages requested at once
+
+async def _request_activities_page(
+    access_token: str,
     after_timestamp: int,
-    activity_type: str = "Ride",
-    page: int = 1,
-    per_page: int = 30
-) -> List[Dict[str, Any]]:
-    """Get activities from Strava API after a specific date"""
+    page: int,
+    per_page: int,
+    etag: Optional[str] = None
+) -> Optional[httpx.Response]:
+    """Request one page of activities, conditionally if an ETag is given (None on error)"""
     url = "https://www.strava.com/api/v3/athlete/activities"
     headers = {"Authorization": f"Bearer {access_token}"}
+    if etag:
+        headers["If-None-Match"] = etag
     params = {
         "after": after_timestamp,
         "page": page,
@@ -174,17 +429,116 @@ async def get_activities_after_date(
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, params=params)
-            activities = response.json()
-            
-            # Filter activities by type
-            if activities and isinstance(activities, list):
-                return [a for a in activities if a.get("type") == activity_type]
-            return []
+        return await _strava_request("GET", url, headers=headers, params=params)
     except Exception as e:
         logger.error(f"Error getting activities: {e}")
-        return []
+        return None
+
+def _parse_activities_page(response: httpx.Response) -> Optional[List[Dict[str, Any]]]:
+    """Decode a page of activities (None on error)"""
+    try:
+        activities = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        activities = None
+    if not isinstance(activities, list):
+        logger.error(f"Strava API activities error: {response.status_code} - {response.text}")
+        return None
+    return activities
+
+async def _get_activities_page(
+    access_token: str,
+    after_timestamp: int,
+    page: int,
+    per_page: int
+) -> Optional[List[Dict[str, Any]]]:
+    """Get one page of activities (None on error)"""
+    response = await _request_activities_page(access_token, after_timestamp, page, per_page)
+    return None if response is None else _parse_activities_page(response)
+
+async def iter_all_activities(
+    access_token: str,
+    after_timestamp: int,
+    activity_type: str = "Ride",
+    per_page: int = STRAVA_MAX_PER_PAGE,
+    start_page: int = 1
+) -> AsyncIterator[Dict[str, Any]]:
+    """Yield all activities from Strava API after a specific date, fetching pages concurrently
+    (raises RuntimeError when a page can't be fetched, so a partial list isn't taken as complete)"""
+    page, batch = start_page, 1
+    while True:
+        results = await asyncio.gather(*[
+            _get_activities_page(access_token, after_timestamp, page + i, per_page)
+            for i in range(batch)
+        ])
+        
+        for i, activities in enumerate(results):
+            if activities is None:
+                raise RuntimeError(f"Failed to get activities page {page + i}")
+            for activity in activities:
+                if activity.get("type") == activity_type:
+                    yield activity
+            # A short page is the last one
+            if len(activities) < per_page:
+                return
+        page += batch
+        
+        # Fetch more pages at once, leaving room in the rate limit for verification requests
+        headroom = _rate_limit.short_remaining()
+        batch = STRAVA_PAGE_CONCURRENCY if headroom is None else max(1, min(STRAVA_PAGE_CONCURRENCY, headroom // 2))
+
+async def get_activities_after_date(
+    access_token: str, 
+    after_timestamp: int,
+    activity_type: str = "Ride",
+    per_page: int = STRAVA_MAX_PER_PAGE,
+    etag: Optional[str] = None
+) -> Tuple[Optional[List[Dict[str, Any]]], Optional[str]]:
+    """Get all activities from Strava API after a specific date and the list's ETag
+    (None activities on errors, no activities if unchanged since etag)"""
+    response = await _request_activities_page(access_token, after_timestamp, 1, per_page, etag)
+    if response is None:
+        return None, None
+    if response.status_code == 304:
+        logger.info("Activity list unchanged since the last check")
+        return [], etag
+    
+    first_page = _parse_activities_page(response)
+    if first_page is None:
+        return None, None
+    activities = [activity for activity in first_page if activity.get("type") == activity_type]
+    
+    # Activities are listed oldest first, so new ones can land on later pages while the
+    # first stays unchanged; the ETag only stands for the whole list when it fits one page
+    if len(first_page) < per_page:
+        return activities, response.headers.get("ETag")
+    
+    try:
+        activities.extend([
+            activity async for activity in iter_all_activities(
+                access_token, after_timestamp, activity_type, per_page, start_page=2
+            )
+        ])
+    except RuntimeError as e:
+        logger.error(f"Error getting activities: {e}")
+        return None, None
+    return activities, None
+
+async def get_athlete_stats(access_token: str, athlete_id: str) -> Dict[str, Any]:
+    """Get the athlete's activity totals from Strava API"""
+    url = f"https://www.strava.com/api/v3/athletes/{athlete_id}/stats"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    
+    try:
+        response = await _strava_request("GET", url, headers=headers)
+        
+        if response.status_code != 200:
+            logger.error(f"Strava API stats error: {response.status_code} - {response.text}")
+            return {"error": f"Strava API returned status code {response.status_code}"}
+        
+        return orjson.loads(response.content)
+    except Exception as e:
+        logger.error(f"Error getting athlete stats: {e}")
+        return {"error": str(e)}
 
 async def get_activity_by_id(
     access_token: str, 
@@ -196,14 +550,13 @@ async def get_activity_by_id(
     params = {"include_all_efforts": False}
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:  # Increased timeout
-            response = await client.get(url, headers=headers, params=params)
+        response = await _strava_request("GET", url, headers=headers, params=params)
+        
+        if response.status_code != 200:
+            logger.error(f"Strava API error: {response.status_code} - {response.text}")
+            return {"error": f"Strava API returned status code {response.status_code}"}
             
-            if response.status_code != 200:
-                logger.error(f"Strava API error: {response.status_code} - {response.text}")
-                return {"error": f"Strava API returned status code {response.status_code}"}
-                
-            return response.json()
+        return orjson.loads(response.content)
     except httpx.TimeoutException:
         logger.error(f"Timeout getting activity details for {activity_id}")
         return {"error": "Request timed out"}
@@ -224,14 +577,13 @@ async def get_activity_streams(
     }
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:  # Increased timeout
-            response = await client.get(url, headers=headers, params=params)
+        response = await _strava_request("GET", url, headers=headers, params=params)
+        
+        if response.status_code != 200:
+            logger.error(f"Strava API streams error: {response.status_code} - {response.text}")
+            return {"error": f"Strava API returned status code {response.status_code}"}
             
-            if response.status_code != 200:
-                logger.error(f"Strava API streams error: {response.status_code} - {response.text}")
-                return {"error": f"Strava API returned status code {response.status_code}"}
-                
-            return response.json()
+        return orjson.loads(response.content)
     except httpx.TimeoutException:
         logger.error(f"Timeout getting activity streams for {activity_id}")
         return {"error": "Request timed out"}
@@ -240,134 +592,290 @@ async def get_activity_streams(
         return {"error": str(e)}
 
 # GPX processing functions
-def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """Calculate the great circle distance between two points"""
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    r = 6371000  # Radius of earth in meters
-    return c * r
-
-def load_gpx_points(gpx_content: str) -> List[Tuple[float, float]]:
-    """Load points (latitude, longitude) from GPX content"""
-    gpx = gpxpy.parse(gpx_content)
-    points = []
-    
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                points.append((point.latitude, point.longitude))
-    
-    return points
-
-def simplify_points(points: List[Tuple[float, float]], tolerance: float = 0.0001) -> List[Tuple[float, float]]:
-    """Simplify a list of points using Douglas-Peucker algorithm"""
+METERS_PER_DEGREE = 111319.9  # Meters per degree of latitude (approximate)
+DISTANCE_CHUNK_PAIRS = 2 ** 14  # (activity point, source segment) pairs compared at once, sized to stay in cache
+SEGMENT_INDEX_CELL_METERS = 100.0  # Cell size of the source segment grid, and the distance it finds segments within
+PROJECTED_DTYPE = np.float32  # Projected meters; float32 resolves ~1 cm within 100 km of the route center
+DEVIATION_DTYPE = np.dtype([("lat", np.float64), ("lon", np.float64), ("deviation", np.float64)])
+
+def load_gpx_points(gpx_content: str) -> np.ndarray:
+    """Load points (latitude, longitude) from GPX content as an array of rows"""
+    # Stream the track points instead of building a full gpxpy object tree
+    coords = []
+    for _, elem in ElementTree.iterparse(io.StringIO(gpx_content)):
+        if elem.tag.endswith("}trkpt") or elem.tag == "trkpt":
+            coords.append(float(elem.get("lat")))
+            coords.append(float(elem.get("lon")))
+            elem.clear()
+    
+    return np.array(coords, dtype=np.float64).reshape(-1, 2)
+
+def simplify_points(points: np.ndarray, tolerance: float = 0.0001) -> np.ndarray:
+    """Simplify points using Douglas-Peucker algorithm, returning an array of (lat, lon) rows"""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
     if len(points) < 3:
         return points
-        
-    line = LineString([(p[1], p[0]) for p in points])  # (lon, lat) for LineString
-    simplified = line.simplify(tolerance)
     
-    # Convert back to (lat, lon)
-    return [(y, x) for x, y in simplified.coords]
+    # Plain Douglas-Peucker; the topology-preserving variant checks for
+    # self-intersections, which a route comparison doesn't need
+    line = LineString(points[:, ::-1])  # (lon, lat) for LineString
+    simplified = line.simplify(tolerance, preserve_topology=False)
+    
+    # Convert back to contiguous (lat, lon) rows
+    return np.ascontiguousarray(np.asarray(simplified.coords)[:, ::-1])
+
+class SourceRoute(NamedTuple):
+    """Simplified source route segments, projected to local float32 meters"""
+    point_count: int  # Track points before simplification
+    lat0: float
+    lon0: float
+    x_scale: float
+    start_x: np.ndarray
+    start_y: np.ndarray
+    vec_x: np.ndarray
+    vec_y: np.ndarray
+    len2: np.ndarray
+    # Grid index: segments passing within one cell size of each cell, grouped by sorted cell key
+    grid_x0: float
+    grid_y0: float
+    grid_rows: int
+    cell_keys: np.ndarray
+    cell_starts: np.ndarray
+    cell_counts: np.ndarray
+    cell_segments: np.ndarray
+
+def project_points(points: np.ndarray, lat0: float, lon0: float, x_scale: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Project (lat, lon) rows to local (x, y) meters around (lat0, lon0)"""
+    return (points[:, 1] - lon0) * x_scale, (points[:, 0] - lat0) * METERS_PER_DEGREE
+
+def prepare_source_route(source_gpx_content: str) -> SourceRoute:
+    """Parse, simplify and project a source GPX route"""
+    source_points = load_gpx_points(source_gpx_content)
+    point_count = len(source_points)
+    if not point_count:
+        empty = np.empty(0, dtype=PROJECTED_DTYPE)
+        no_cells = np.empty(0, dtype=np.int64)
+        return SourceRoute(
+            0, 0.0, 0.0, METERS_PER_DEGREE, empty, empty, empty, empty, empty,
+            0.0, 0.0, 1, no_cells, no_cells, no_cells, no_cells
+        )
+    
+    source = simplify_points(source_points)
+    
+    # Project to local (x, y) meters around the source route's mean position, so
+    # distances need no degree conversion and longitude is scaled by cos(latitude)
+    lat0, lon0 = source.mean(axis=0)
+    x_scale = math.cos(math.radians(lat0)) * METERS_PER_DEGREE
+    source_x, source_y = project_points(source, lat0, lon0, x_scale)
+    
+    # Source segments (a single point is a zero-length segment), downcast only after projecting
+    if len(source_x) < 2:
+        source_x, source_y = np.repeat(source_x, 2), np.repeat(source_y, 2)
+    vec_x = np.diff(source_x).astype(PROJECTED_DTYPE)
+    vec_y = np.diff(source_y).astype(PROJECTED_DTYPE)
+    len2 = vec_x * vec_x + vec_y * vec_y
+    len2[len2 == 0] = 1.0
+    
+    grid_x0, grid_y0, grid_rows, cell_keys, cell_starts, cell_counts, cell_segments = _build_segment_grid(
+        source_x, source_y, SEGMENT_INDEX_CELL_METERS
+    )
+    
+    return SourceRoute(
+        point_count, float(lat0), float(lon0), x_scale,
+        source_x[:-1].astype(PROJECTED_DTYPE), source_y[:-1].astype(PROJECTED_DTYPE), vec_x, vec_y, len2,
+        grid_x0, grid_y0, grid_rows, cell_keys, cell_starts, cell_counts, cell_segments
+    )
+
+def _build_segment_grid(
+    x: np.ndarray,
+    y: np.ndarray,
+    cell: float
+) -> Tuple[float, float, int, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Grid of the segments of a projected line passing within one cell size of each cell"""
+    # Cell ranges covered by every segment's bounding box, grown by one cell size
+    grid_x0, grid_y0 = x.min() - cell, y.min() - cell
+    grid_rows = int((y.max() + cell - grid_y0) // cell) + 1
+    low_x = ((np.minimum(x[:-1], x[1:]) - cell - grid_x0) // cell).astype(np.int64)
+    low_y = ((np.minimum(y[:-1], y[1:]) - cell - grid_y0) // cell).astype(np.int64)
+    span_x = ((np.maximum(x[:-1], x[1:]) + cell - grid_x0) // cell).astype(np.int64) - low_x + 1
+    span_y = ((np.maximum(y[:-1], y[1:]) + cell - grid_y0) // cell).astype(np.int64) - low_y + 1
+    
+    # One (segment, cell) pair per covered cell, enumerated row-major within each box
+    cell_total = span_x * span_y
+    segments = np.repeat(np.arange(len(cell_total)), cell_total)
+    slots = np.arange(len(segments)) - np.repeat(np.cumsum(cell_total) - cell_total, cell_total)
+    keys = (low_x[segments] + slots // span_y[segments]) * grid_rows + low_y[segments] + slots % span_y[segments]
+    
+    # Group the pairs by cell
+    order = np.argsort(keys, kind="stable")
+    cell_keys, cell_starts, cell_counts = np.unique(keys[order], return_index=True, return_counts=True)
+    return float(grid_x0), float(grid_y0), grid_rows, cell_keys, cell_starts, cell_counts, segments[order]
+
+def _segment_dist2(source_route: SourceRoute, x: np.ndarray, y: np.ndarray, segments) -> np.ndarray:
+    """Squared distance from points to source segments, elementwise or broadcast"""
+    offset_x = x - source_route.start_x[segments]
+    offset_y = y - source_route.start_y[segments]
+    vec_x, vec_y = source_route.vec_x[segments], source_route.vec_y[segments]
+    t = np.clip((offset_x * vec_x + offset_y * vec_y) / source_route.len2[segments], 0.0, 1.0)
+    residual_x = offset_x - t * vec_x
+    residual_y = offset_y - t * vec_y
+    return residual_x * residual_x + residual_y * residual_y
+
+def _cell_lookup(source_route: SourceRoute, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Grid cell of every point: whether any segment passes near it, and its position in cell_keys"""
+    cell = SEGMENT_INDEX_CELL_METERS
+    rows = ((y - source_route.grid_y0) // cell).astype(np.int64)
+    keys = ((x - source_route.grid_x0) // cell).astype(np.int64) * source_route.grid_rows + rows
+    found = np.searchsorted(source_route.cell_keys, keys).clip(max=max(len(source_route.cell_keys) - 1, 0))
+    indexed = np.zeros(len(x), dtype=bool)
+    if len(source_route.cell_keys):
+        # Rows outside the grid would alias cells of the next column
+        indexed = (source_route.cell_keys[found] == keys) & (rows >= 0) & (rows < source_route.grid_rows)
+    return indexed, found
+
+def _nearest_dist2(
+    source_route: SourceRoute,
+    x: np.ndarray,
+    y: np.ndarray,
+    indexed: np.ndarray,
+    found: np.ndarray
+) -> np.ndarray:
+    """Squared distance from every point to its closest source segment, given the points' cells"""
+    dist2 = np.full(len(x), np.inf, dtype=PROJECTED_DTYPE)
+    cell = SEGMENT_INDEX_CELL_METERS
+    
+    # Candidate segments from each point's grid cell; they include every segment
+    # within one cell size of the point, so a candidate that close is the closest.
+    # Cells come from the float64 projection, matching the grid build; distances use float32
+    x, y = x.astype(PROJECTED_DTYPE), y.astype(PROJECTED_DTYPE)
+    indexed_points = np.flatnonzero(indexed)
+    if len(indexed_points):
+        counts = source_route.cell_counts[found[indexed_points]]
+        pair_points = np.repeat(indexed_points, counts)
+        first_pair = np.cumsum(counts) - counts
+        pair_slots = np.arange(len(pair_points)) - np.repeat(first_pair, counts)
+        pair_slots += np.repeat(source_route.cell_starts[found[indexed_points]], counts)
+        pair_dist2 = _segment_dist2(
+            source_route, x[pair_points], y[pair_points], source_route.cell_segments[pair_slots]
+        )
+        dist2[indexed_points] = np.minimum.reduceat(pair_dist2, first_pair)
+    
+    # Points farther from the route than that are compared with every segment,
+    # in chunks so the temporaries stay small
+    far_points = np.flatnonzero(dist2 > cell * cell)
+    chunk = max(1, DISTANCE_CHUNK_PAIRS // len(source_route.start_x))
+    for i in range(0, len(far_points), chunk):
+        points = far_points[i:i + chunk]
+        dist2[points] = _segment_dist2(source_route, x[points, None], y[points, None], slice(None)).min(axis=1)
+    
+    return dist2
 
 def calculate_similarity(
-    source_points: List[Tuple[float, float]],
-    activity_points: List[Tuple[float, float]],
-    max_deviation: float = 20.0  # Maximum deviation in meters
-) -> Tuple[float, List[Tuple[float, float, float]]]:
-    """Calculate similarity between source route and activity route"""
-    # Create LineString from source points
-    source_line = LineString([(p[1], p[0]) for p in source_points])  # (lon, lat) for LineString
-    
-    # Check each activity point against the source line
-    deviations = []
-    points_within_threshold = 0
-    
-    for lat, lon in activity_points:
-        point = Point(lon, lat)  # (lon, lat) for Point
-        distance = source_line.distance(point) * 111319.9  # Convert degrees to meters (approximate)
-        deviations.append((lat, lon, distance))
-        
-        if distance <= max_deviation:
-            points_within_threshold += 1
+    source_route: SourceRoute,
+    activity_points: np.ndarray,
+    max_deviation: float = 20.0,  # Maximum deviation in meters
+    threshold: Optional[float] = None
+) -> Tuple[float, np.ndarray, bool]:
+    """Calculate similarity between source route and activity route, and whether it was fully measured"""
+    if not len(activity_points):
+        return 0, np.empty(0, dtype=DEVIATION_DTYPE), True
+    
+    # Project the activity with the source route's projection
+    activity = np.asarray(activity_points, dtype=np.float64).reshape(-1, 2)
+    activity_x, activity_y = project_points(activity, source_route.lat0, source_route.lon0, source_route.x_scale)
+    indexed, found = _cell_lookup(source_route, activity_x, activity_y)
+    
+    deviations = np.empty(len(activity), dtype=DEVIATION_DTYPE)
+    deviations["lat"] = activity[:, 0]
+    deviations["lon"] = activity[:, 1]
+    
+    # Points in cells no segment passes near are over a cell size, so over max_deviation, off the route.
+    # If that alone rules out the threshold, skip measuring and return the bound with NaN deviations.
+    if threshold is not None and max_deviation <= SEGMENT_INDEX_CELL_METERS:
+        best_score = int(indexed.sum()) / len(activity)
+        if best_score < threshold:
+            deviations["deviation"] = np.nan
+            return best_score, deviations, False
+    
+    # Squared distance from every activity point to its closest source segment
+    dist2 = _nearest_dist2(source_route, activity_x, activity_y, indexed, found)
+    deviations["deviation"] = np.sqrt(dist2)
     
     # Calculate similarity score (percentage of points within threshold)
-    similarity_score = points_within_threshold / len(activity_points) if activity_points else 0
+    points_within_threshold = int((dist2 <= max_deviation ** 2).sum())
+    similarity_score = points_within_threshold / len(activity)
     
-    return similarity_score, deviations
+    return similarity_score, deviations, True
+
+class VerifyResult(NamedTuple):
+    """Outcome of verifying an activity against one source route"""
+    verified: bool
+    similarity_score: float
+    message: str
 
 def verify_activity_against_source(
-    source_gpx_content: str,
-    activity_points: List[Tuple[float, float]],
-    activity_distance: float  # Distance in meters
-) -> Dict[str, any]:
+    source_route: SourceRoute,
+    activity_points: np.ndarray,
+    activity_distance: float,  # Distance in meters
+    simplified_points: Optional[np.ndarray] = None  # simplify_points(activity_points), if already computed
+) -> VerifyResult:
     """Verify if an activity matches a source GPX route"""
     # Check minimum distance requirement
     required_distance = settings.MIN_ACTIVITY_DISTANCE_KM * 1000  # Convert to meters
     if activity_distance < required_distance:
-        return {
-            "verified": False,
-            "similarity_score": 0.0,
-            "message": f"Activity distance ({activity_distance/1000:.1f}km) is less than required ({settings.MIN_ACTIVITY_DISTANCE_KM}km)"
-        }
-    
-    # Load source route points
-    try:
-        source_points = load_gpx_points(source_gpx_content)
-    except Exception as e:
-        return {
-            "verified": False,
-            "similarity_score": 0.0,
-            "message": f"Error loading source GPX: {str(e)}"
-        }
+        return VerifyResult(
+            verified=False,
+            similarity_score=0.0,
+            message=f"Activity distance ({activity_distance/1000:.1f}km) is less than required ({settings.MIN_ACTIVITY_DISTANCE_KM}km)"
+        )
     
     # Check if we have enough points
-    if len(source_points) < 10 or len(activity_points) < 10:
-        return {
-            "verified": False,
-            "similarity_score": 0.0,
-            "message": "Not enough GPS points to perform verification"
-        }
-    
-    # Simplify routes for faster comparison
-    source_points = simplify_points(source_points)
-    activity_points = simplify_points(activity_points)
-    
-    # Calculate similarity
-    similarity_score, deviations = calculate_similarity(
-        source_points,
-        activity_points,
-        max_deviation=settings.GPS_MAX_DEVIATION_METERS
+    if source_route.point_count < 10 or len(activity_points) < 10:
+        return VerifyResult(
+            verified=False,
+            similarity_score=0.0,
+            message="Not enough GPS points to perform verification"
+        )
+    
+    # Simplify the activity for faster comparison (the source route is already simplified)
+    if simplified_points is None:
+        simplified_points = simplify_points(activity_points)
+    
+    # Calculate similarity (rejecting activities mostly away from the route early)
+    similarity_score, deviations, complete = calculate_similarity(
+        source_route,
+        simplified_points,
+        max_deviation=settings.GPS_MAX_DEVIATION_METERS,
+        threshold=settings.ROUTE_SIMILARITY_THRESHOLD
     )
     
     # Check if similarity meets threshold
     verified = similarity_score >= settings.ROUTE_SIMILARITY_THRESHOLD
+    bound = "" if complete else "at most "
     
-    return {
-        "verified": verified,
-        "similarity_score": similarity_score,
-        "message": (
+    return VerifyResult(
+        verified=verified,
+        similarity_score=similarity_score,
+        message=(
             f"Route verified successfully with {similarity_score:.1%} match"
             if verified else
-            f"Route similarity ({similarity_score:.1%}) below required threshold ({settings.ROUTE_SIMILARITY_THRESHOLD:.1%})"
+            f"Route similarity ({bound}{similarity_score:.1%}) below required threshold ({settings.ROUTE_SIMILARITY_THRESHOLD:.1%})"
         )
-    }
+    )
 
 def convert_strava_streams_to_points(
     streams: Dict[str, any]
-) -> List[Tuple[float, float]]:
-    """Convert Strava API streams to list of points"""
+) -> np.ndarray:
+    """Convert Strava API streams to an array of (lat, lon) rows"""
     if not streams or "latlng" not in streams:
-        return []
+        return np.empty((0, 2))
     
     latlng_data = streams["latlng"]["data"]
-    return [(point[0], point[1]) for point in latlng_data if len(point) == 2]
+    try:
+        return np.asarray(latlng_data, dtype=np.float64).reshape(-1, 2)
+    except ValueError:
+        # Ragged stream with incomplete points; keep only the complete ones
+        return np.array([point for point in latlng_data if len(point) == 2], dtype=np.float64).reshape(-1, 2)
 
 async def load_source_gpx_file(filename: str) -> Tuple[bool, str]:
     """Load source GPX file content"""
@@ -384,37 +892,125 @@ async def load_source_gpx_file(filename: str) -> Tuple[bool, str]:
     except Exception as e:
         return False, f"Error loading GPX file: {str(e)}"
 
+SOURCE_ROUTE_FORMAT_VERSION = 1  # Bump when SourceRoute or its grid changes, so saved routes are rebuilt
+
+def source_route_path(gpx_path: Path) -> Path:
+    """Path of the prepared route saved next to a source GPX file (the backend saves its own as .npz)"""
+    return gpx_path.with_suffix(".worker.npz")
+
+def save_source_route(source_route: SourceRoute, path: Path) -> None:
+    """Save a prepared source route to an .npz file"""
+    # Write under a unique name and rename, so concurrent checks never read a partial file
+    temp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temp_path, "wb") as f:
+            np.savez(f, version=SOURCE_ROUTE_FORMAT_VERSION, **source_route._asdict())
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+def read_saved_source_route(path: Path) -> Optional[SourceRoute]:
+    """Load a prepared source route saved by save_source_route (None if saved by another format version)"""
+    with np.load(path) as data:
+        if int(data["version"]) != SOURCE_ROUTE_FORMAT_VERSION:
+            return None
+        # Scalar fields come back as 0-d arrays
+        return SourceRoute(*(
+            field_type(data[name]) if field_type in (int, float) else data[name]
+            for name, field_type in SourceRoute.__annotations__.items()
+        ))
+
+def _read_or_prepare_source_route(file_path: Path, mtime: float) -> SourceRoute:
+    """Read the saved route of a source GPX file, preparing and saving it if missing or outdated"""
+    route_path = source_route_path(file_path)
+    try:
+        if route_path.stat().st_mtime >= mtime:
+            source_route = read_saved_source_route(route_path)
+            if source_route is not None:
+                return source_route
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Error reading saved route for {file_path.name}: {e}")
+    
+    with open(file_path, "r") as f:
+        source_route = prepare_source_route(f.read())
+    
+    # A read-only source directory only costs preparing the route again after a restart
+    try:
+        save_source_route(source_route, route_path)
+    except OSError as e:
+        logger.warning(f"Error saving route for {file_path.name}: {e}")
+    
+    return source_route
+
+# Prepared source routes by filename, with the file mtime they were built from
+_source_routes: Dict[str, Tuple[float, SourceRoute]] = {}
+
+async def load_source_route(filename: str) -> Tuple[bool, Union[SourceRoute, str]]:
+    """Load a prepared source route, parsing the GPX file only when it changed since it was saved"""
+    file_path = Path(settings.SOURCE_GPX_PATH) / filename
+    try:
+        mtime = file_path.stat().st_mtime
+    except FileNotFoundError:
+        return False, f"File {filename} not found"
+    
+    cached = _source_routes.get(filename)
+    if cached and cached[0] == mtime:
+        return True, cached[1]
+    
+    try:
+        source_route = await asyncio.to_thread(_read_or_prepare_source_route, file_path, mtime)
+    except FileNotFoundError:
+        return False, f"File {filename} not found"
+    except Exception as e:
+        return False, f"Error loading source GPX: {str(e)}"
+    
+    _source_routes[filename] = (mtime, source_route)
+    return True, source_route
+
 async def update_leaderboard(db: Session, user_id: str) -> None:
-    """Update leaderboard entry for user"""
-    # Get user
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
+    """Update leaderboard entry for user (the caller commits)"""
+    # The session doesn't autoflush, so send the newly added activity before counting
+    db.flush()
+    
+    # Recount approved activities and upsert the entry in a single statement
+    activity_count = (
+        select(func.count()).select_from(Activity).filter(Activity.user_id == User.id).scalar_subquery()
+    )
+    upsert = pg_insert(Leaderboard).from_select(
+        ["id", "first_name", "last_name", "activity_count", "last_updated"],
+        select(User.id, User.first_name, User.last_name, activity_count, func.now()).filter(User.id == user_id)
+    )
+    result = db.execute(
+        upsert.on_conflict_do_update(
+            index_elements=[Leaderboard.id],
+            set_={
+                "activity_count": upsert.excluded.activity_count,
+                "last_updated": func.now()
+            }
+        ).returning(Leaderboard.activity_count)
+    )
+    
+    count = result.scalar()
+    if count is None:
         logger.warning(f"User not found for leaderboard update: {user_id}")
         return
     
-    # Count approved activities
-    activity_count = db.query(Activity).filter(
-        Activity.user_id == user_id
-    ).count()
-    
-    logger.info(f"Updating leaderboard for user {user_id}, activity count: {activity_count}")
-    
-    # Update or create leaderboard entry
-    leaderboard_entry = db.query(Leaderboard).filter(
-        Leaderboard.id == user_id
-    ).first()
-    
-    if leaderboard_entry:
-        leaderboard_entry.activity_count = activity_count
-        leaderboard_entry.last_updated = datetime.now()
-    else:
-        new_entry = Leaderboard(
-            id=user_id,
-            first_name=user.first_name,
-            last_name=user.last_name,
-            activity_count=activity_count,
-            last_updated=datetime.now()
-        )
-        db.add(new_entry)
+    logger.info(f"Updating leaderboard for user {user_id}, activity count: {count}")
+
+async def bump_leaderboard(db: Session, user_id: str, added: int = 1) -> None:
+    """Count newly approved activities on the user's leaderboard entry (the caller commits)"""
+    # Constant-time increment of an existing entry; only a first entry needs the full count
+    result = db.execute(
+        update(Leaderboard)
+        .where(Leaderboard.id == user_id)
+        .values(activity_count=Leaderboard.activity_count + added, last_updated=func.now())
+        .returning(Leaderboard.activity_count)
+    )
+    
+    count = result.scalar()
+    if count is None:
+        return await update_leaderboard(db, user_id)
     
-    db.commit()
\ No newline at end of file
+    logger.info(f"Updating leaderboard for user {user_id}, activity count: {count}")
\ No newline at end of file
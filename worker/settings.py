@@ -1,4 +1,6 @@
 import os
+from typing import Optional
+
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -7,34 +9,41 @@ load_dotenv()
 class Settings:
     """Application settings loaded from environment variables"""
     
+    # Values are read once at import and live on the class; instances carry no attribute dict
+    __slots__ = ()
+    
     # Project settings
-    PROJECT_NAME = os.getenv("PROJECT_NAME", "Komornicka 100")
+    PROJECT_NAME: str = os.getenv("PROJECT_NAME", "Komornicka 100")
     
     # Database settings
-    DATABASE_URL = os.getenv("DATABASE_URL")
+    DATABASE_URL: Optional[str] = os.getenv("DATABASE_URL")
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))  # One connection per concurrently checked user
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Seconds before a connection is replaced
     
     # Security settings
-    SECRET_KEY = os.getenv("SECRET_KEY", "default-secret-key")
+    SECRET_KEY: str = os.getenv("SECRET_KEY", "default-secret-key")
     
     # Strava API settings
-    STRAVA_CLIENT_ID = os.getenv("STRAVA_CLIENT_ID")
-    STRAVA_CLIENT_SECRET = os.getenv("STRAVA_CLIENT_SECRET")
+    STRAVA_CLIENT_ID: Optional[str] = os.getenv("STRAVA_CLIENT_ID")
+    STRAVA_CLIENT_SECRET: Optional[str] = os.getenv("STRAVA_CLIENT_SECRET")
+    USER_CONCURRENCY: int = int(os.getenv("USER_CONCURRENCY", "10"))  # Users whose activities are checked at once
     
     # Email settings
-    SMTP_SERVER = os.getenv("SMTP_SERVER", "localhost")
-    SMTP_PORT = int(os.getenv("SMTP_PORT", "25"))
-    SMTP_FROM = os.getenv("SMTP_FROM", "")
-    SMTP_USERNAME = os.getenv("SMTP_USERNAME", "")
-    SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")
+    SMTP_SERVER: str = os.getenv("SMTP_SERVER", "localhost")
+    SMTP_PORT: int = int(os.getenv("SMTP_PORT", "25"))
+    SMTP_FROM: str = os.getenv("SMTP_FROM", "")
+    SMTP_USERNAME: str = os.getenv("SMTP_USERNAME", "")
+    SMTP_PASSWORD: str = os.getenv("SMTP_PASSWORD", "")
     
     # URL settings
-    FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
+    FRONTEND_URL: str = os.getenv("FRONTEND_URL", "http://localhost:3000")
     
     # GPX verification settings
-    SOURCE_GPX_PATH = os.getenv("SOURCE_GPX_PATH", "data")
-    ROUTE_SIMILARITY_THRESHOLD = float(os.getenv("ROUTE_SIMILARITY_THRESHOLD", "0.8"))
-    GPS_MAX_DEVIATION_METERS = float(os.getenv("GPS_MAX_DEVIATION_METERS", "20.0"))
-    MIN_ACTIVITY_DISTANCE_KM = float(os.getenv("MIN_ACTIVITY_DISTANCE_KM", "100.0"))
+    SOURCE_GPX_PATH: str = os.getenv("SOURCE_GPX_PATH", "data")
+    ROUTE_SIMILARITY_THRESHOLD: float = float(os.getenv("ROUTE_SIMILARITY_THRESHOLD", "0.8"))
+    GPS_MAX_DEVIATION_METERS: float = float(os.getenv("GPS_MAX_DEVIATION_METERS", "20.0"))
+    MIN_ACTIVITY_DISTANCE_KM: float = float(os.getenv("MIN_ACTIVITY_DISTANCE_KM", "100.0"))
 
 # Create global settings object
 settings = Settings()
\ No newline at end of file
@@ -1,8 +1,11 @@
+import asyncio
 import logging
 import uuid
 from datetime import datetime
-from typing import Dict, List, Tuple, Any
+from typing import Dict, Any, Optional
 
+import numpy as np
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
 from models import User, Activity, ActivityAttempt, SourceGPX
@@ -10,10 +13,11 @@ from services import (
     ensure_fresh_token, 
     get_activity_by_id, 
     get_activity_streams,
-    load_source_gpx_file,
+    load_source_route,
     convert_strava_streams_to_points,
+    simplify_points,
     verify_activity_against_source,
-    update_leaderboard,
+    bump_leaderboard,
     send_activity_verification_email
 )
 
@@ -22,25 +26,39 @@ logger = logging.getLogger("kmtb-worker")
 
 async def verify_strava_activity(
     db: Session,
-    user_id: str,
+    user: User,
     activity_id: str,
-    source_gpx_id: str = None
+    source_gpx_id: str = None,
+    commit: bool = True,
+    access_token: Optional[str] = None
 ) -> Dict[str, any]:
-    """Verify a Strava activity against a source GPX file"""
+    """Verify a Strava activity against a source GPX file (commit=False leaves committing, sending the
+    returned pending_email and counting activity_added on the leaderboard to the caller, which then also
+    passes access_token so no refresh commits mid-batch; failures marked transient may succeed on a later check)"""
+    user_id = str(user.id)
+    
     # Ensure fresh token
-    token_success, token_value = await ensure_fresh_token(db, user_id)
-    if not token_success:
-        return {
-            "success": False,
-            "message": f"Failed to get valid token: {token_value}"
-        }
+    if access_token:
+        token_value = access_token
+    else:
+        token_success, token_value = await ensure_fresh_token(db, user_id)
+        if not token_success:
+            return {
+                "success": False,
+                "message": f"Failed to get valid token: {token_value}",
+                "transient": True
+            }
     
-    # Get activity details
-    activity_details = await get_activity_by_id(token_value, activity_id)
+    # Get activity details and streams (GPS data) concurrently
+    activity_details, streams = await asyncio.gather(
+        get_activity_by_id(token_value, activity_id),
+        get_activity_streams(token_value, activity_id)
+    )
     if "error" in activity_details:
         return {
             "success": False,
-            "message": f"Failed to get activity details: {activity_details.get('error')}"
+            "message": f"Failed to get activity details: {activity_details.get('error')}",
+            "transient": True
         }
     
     # Check if activity is a ride
@@ -50,17 +68,17 @@ async def verify_strava_activity(
             "message": f"Activity is not a bike ride (type: {activity_details.get('type')})"
         }
     
-    # Get activity streams (GPS data)
-    streams = await get_activity_streams(token_value, activity_id)
+    # Check the streams were fetched
     if "error" in streams:
         return {
             "success": False,
-            "message": f"Failed to get activity streams: {streams.get('error')}"
+            "message": f"Failed to get activity streams: {streams.get('error')}",
+            "transient": True
         }
     
     # Convert streams to points
     activity_points = convert_strava_streams_to_points(streams)
-    if not activity_points:
+    if not len(activity_points):
         return {
             "success": False,
             "message": "No GPS data found in activity"
@@ -72,26 +90,36 @@ async def verify_strava_activity(
     # If source_gpx_id provided, verify against that specific source
     if source_gpx_id:
         return await verify_against_specific_source(
-            db, user_id, activity_id, source_gpx_id, 
-            activity_details, activity_points, activity_distance
+            db, user, activity_id, source_gpx_id, 
+            activity_details, activity_points, activity_distance, commit
         )
     else:
         # If no source_gpx_id provided, check against all active sources
         return await verify_against_all_sources(
-            db, user_id, activity_id, 
-            activity_details, activity_points, activity_distance
+            db, user, activity_id, 
+            activity_details, activity_points, activity_distance, commit
         )
 
 async def verify_against_specific_source(
     db: Session,
-    user_id: str,
+    user: User,
     activity_id: str,
     source_gpx_id: str,
     activity_details: Dict[str, any],
-    activity_points: List[Tuple[float, float]],
-    activity_distance: float
+    activity_points: np.ndarray,
+    activity_distance: float,
+    commit: bool = True
 ) -> Dict[str, any]:
     """Verify activity against a specific source GPX"""
+    user_id = str(user.id)
+    
+    # Read the activity fields once for the attempt and activity rows (and the email)
+    start_date = datetime.fromisoformat(activity_details.get("start_date"))
+    activity_name = activity_details.get("name", "Unknown Activity")
+    duration = activity_details.get("elapsed_time", 0)
+    pending_email = None
+    activity_added = False
+    
     # Get source GPX
     source_gpx = db.query(SourceGPX).filter(
         SourceGPX.id == source_gpx_id,
@@ -101,20 +129,22 @@ async def verify_against_specific_source(
     if not source_gpx:
         return {
             "success": False,
-            "message": f"Source GPX with ID {source_gpx_id} not found or inactive"
+            "message": f"Source GPX with ID {source_gpx_id} not found or inactive",
+            "transient": True
         }
     
-    # Load source GPX file
-    load_success, content = await load_source_gpx_file(source_gpx.filename)
+    # Load the prepared source route
+    load_success, source_route = await load_source_route(source_gpx.filename)
     if not load_success:
         return {
             "success": False,
-            "message": f"Failed to load source GPX file: {content}"
+            "message": f"Failed to load source GPX file: {source_route}",
+            "transient": True
         }
     
-    # Verify activity against source
-    verification_result = verify_activity_against_source(
-        content, activity_points, activity_distance
+    # Verify activity against source, off the event loop
+    verification_result = await asyncio.to_thread(
+        verify_activity_against_source, source_route, activity_points, activity_distance
     )
     
     # Record verification attempt
@@ -123,19 +153,19 @@ async def verify_against_specific_source(
         user_id=user_id,
         strava_activity_id=activity_id,
         source_gpx_id=source_gpx_id,
-        name=activity_details.get("name", "Unknown Activity"),
+        name=activity_name,
         distance=activity_distance,
-        duration=activity_details.get("elapsed_time", 0),
-        start_date=datetime.fromisoformat(activity_details.get("start_date").replace("Z", "+00:00")),
-        is_verified=verification_result["verified"],
-        similarity_score=verification_result["similarity_score"],
-        verification_message=verification_result["message"]
+        duration=duration,
+        start_date=start_date,
+        is_verified=verification_result.verified,
+        similarity_score=verification_result.similarity_score,
+        verification_message=verification_result.message
     )
     
     db.add(activity_attempt)
     
     # If verified, record as approved activity
-    if verification_result["verified"]:
+    if verification_result.verified:
         # Check if already recorded
         existing = db.query(Activity).filter(
             Activity.strava_activity_id == activity_id
@@ -148,51 +178,68 @@ async def verify_against_specific_source(
                 user_id=user_id,
                 strava_activity_id=activity_id,
                 source_gpx_id=source_gpx_id,
-                name=activity_details.get("name", "Unknown Activity"),
+                name=activity_name,
                 distance=activity_distance,
-                duration=activity_details.get("elapsed_time", 0),
-                start_date=datetime.fromisoformat(activity_details.get("start_date").replace("Z", "+00:00")),
-                similarity_score=verification_result["similarity_score"]
+                duration=duration,
+                start_date=start_date,
+                similarity_score=verification_result.similarity_score
             )
             
             db.add(new_activity)
             
-            # Update leaderboard
-            await update_leaderboard(db, user_id)
+            # Update leaderboard now, or leave it to the batch's caller, which counts all its
+            # new activities at once, so the entry isn't locked while the batch is still fetching
+            if commit:
+                await bump_leaderboard(db, user_id)
+            activity_added = True
             
-            # Send verification email
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                send_activity_verification_email(
-                    user.email,
-                    user.first_name,
-                    activity_details.get("name", "Unknown Activity"),
-                    activity_details.get("start_date_local", "Unknown date"),
-                    source_gpx.name
-                )
+            # Queue the verification email; it goes out only once the activity is committed
+            pending_email = (
+                user.email,
+                user.first_name,
+                activity_name,
+                activity_details.get("start_date_local", "Unknown date"),
+                source_gpx.name
+            )
     
-    db.commit()
+    if commit:
+        db.commit()
+        if pending_email:
+            await asyncio.to_thread(send_activity_verification_email, *pending_email)
+            pending_email = None
     
     return {
         "success": True,
-        "verified": verification_result["verified"],
-        "similarity_score": verification_result["similarity_score"],
-        "message": verification_result["message"],
+        "verified": verification_result.verified,
+        "similarity_score": verification_result.similarity_score,
+        "message": verification_result.message,
         "source_gpx": {
             "id": source_gpx.id,
             "name": source_gpx.name
-        }
+        },
+        "pending_email": pending_email,
+        "activity_added": activity_added
     }
 
 async def verify_against_all_sources(
     db: Session,
-    user_id: str,
+    user: User,
     activity_id: str,
     activity_details: Dict[str, any],
-    activity_points: List[Tuple[float, float]],
-    activity_distance: float
+    activity_points: np.ndarray,
+    activity_distance: float,
+    commit: bool = True
 ) -> Dict[str, any]:
     """Verify activity against all active source GPXs"""
+    user_id = str(user.id)
+    
+    # Read the activity fields once for the attempt and activity rows (and the email)
+    start_date = datetime.fromisoformat(activity_details.get("start_date"))
+    activity_name = activity_details.get("name", "Unknown Activity")
+    duration = activity_details.get("elapsed_time", 0)
+    pending_email = None
+    activity_added = False
+    
     # Get all active source GPXs
     source_gpxs = db.query(SourceGPX).filter(
         SourceGPX.is_active == True
@@ -201,7 +248,8 @@ async def verify_against_all_sources(
     if not source_gpxs:
         return {
             "success": False,
-            "message": "No active source GPX routes found"
+            "message": "No active source GPX routes found",
+            "transient": True
         }
     
     best_result = {
@@ -211,48 +259,67 @@ async def verify_against_all_sources(
         "source_gpx": None
     }
     
-    # Check against each source
+    # Load the prepared source routes
+    loaded_sources = []
     for source_gpx in source_gpxs:
-        # Load source GPX file
-        load_success, content = await load_source_gpx_file(source_gpx.filename)
+        load_success, source_route = await load_source_route(source_gpx.filename)
         if not load_success:
-            logger.warning(f"Failed to load source GPX file {source_gpx.filename}: {content}")
+            logger.warning(f"Failed to load source GPX file {source_gpx.filename}: {source_route}")
             continue
-        
-        # Verify activity against source
-        verification_result = verify_activity_against_source(
-            content, activity_points, activity_distance
+        loaded_sources.append((source_gpx, source_route))
+    
+    if not loaded_sources:
+        return {
+            "success": False,
+            "message": "Failed to load any active source GPX file",
+            "transient": True
+        }
+    
+    # Simplify the activity once for all sources
+    simplified_points = await asyncio.to_thread(simplify_points, activity_points)
+    
+    # Verify against every source at once in threads; numpy releases the GIL in the distance kernels
+    verification_results = await asyncio.gather(*(
+        asyncio.to_thread(
+            verify_activity_against_source, source_route, activity_points, activity_distance, simplified_points
         )
-        
+        for _, source_route in loaded_sources
+    ))
+    
+    # Check against each source
+    attempts = []
+    for (source_gpx, _), verification_result in zip(loaded_sources, verification_results):
         # Record verification attempt
-        activity_attempt = ActivityAttempt(
-            id=uuid.uuid4(),
-            user_id=user_id,
-            strava_activity_id=activity_id,
-            source_gpx_id=source_gpx.id,
-            name=activity_details.get("name", "Unknown Activity"),
-            distance=activity_distance,
-            duration=activity_details.get("elapsed_time", 0),
-            start_date=datetime.fromisoformat(activity_details.get("start_date").replace("Z", "+00:00")),
-            is_verified=verification_result["verified"],
-            similarity_score=verification_result["similarity_score"],
-            verification_message=verification_result["message"]
-        )
-        
-        db.add(activity_attempt)
+        attempts.append({
+            "id": uuid.uuid4(),
+            "user_id": user_id,
+            "strava_activity_id": activity_id,
+            "source_gpx_id": source_gpx.id,
+            "name": activity_name,
+            "distance": activity_distance,
+            "duration": duration,
+            "start_date": start_date,
+            "is_verified": verification_result.verified,
+            "similarity_score": verification_result.similarity_score,
+            "verification_message": verification_result.message
+        })
         
         # Keep track of best match
-        if verification_result["similarity_score"] > best_result["similarity_score"]:
+        if verification_result.similarity_score > best_result["similarity_score"]:
             best_result = {
-                "verified": verification_result["verified"],
-                "similarity_score": verification_result["similarity_score"],
-                "message": verification_result["message"],
+                "verified": verification_result.verified,
+                "similarity_score": verification_result.similarity_score,
+                "message": verification_result.message,
                 "source_gpx": {
                     "id": source_gpx.id,
                     "name": source_gpx.name
                 }
             }
     
+    # Insert the attempts in one statement, skipping the unit of work bookkeeping
+    if attempts:
+        db.execute(insert(ActivityAttempt), attempts)
+    
     # If verified, record as approved activity
     if best_result["verified"]:
         # Check if already recorded
@@ -267,32 +334,39 @@ async def verify_against_all_sources(
                 user_id=user_id,
                 strava_activity_id=activity_id,
                 source_gpx_id=best_result["source_gpx"]["id"],
-                name=activity_details.get("name", "Unknown Activity"),
+                name=activity_name,
                 distance=activity_distance,
-                duration=activity_details.get("elapsed_time", 0),
-                start_date=datetime.fromisoformat(activity_details.get("start_date").replace("Z", "+00:00")),
+                duration=duration,
+                start_date=start_date,
                 similarity_score=best_result["similarity_score"]
             )
             
             db.add(new_activity)
             
-            # Update leaderboard
-            await update_leaderboard(db, user_id)
+            # Update leaderboard now, or leave it to the batch's caller, which counts all its
+            # new activities at once, so the entry isn't locked while the batch is still fetching
+            if commit:
+                await bump_leaderboard(db, user_id)
+            activity_added = True
             
-            # Send verification email
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                send_activity_verification_email(
-                    user.email,
-                    user.first_name,
-                    activity_details.get("name", "Unknown Activity"),
-                    activity_details.get("start_date_local", "Unknown date"),
-                    best_result["source_gpx"]["name"]
-                )
+            # Queue the verification email; it goes out only once the activity is committed
+            pending_email = (
+                user.email,
+                user.first_name,
+                activity_name,
+                activity_details.get("start_date_local", "Unknown date"),
+                best_result["source_gpx"]["name"]
+            )
     
-    db.commit()
+    if commit:
+        db.commit()
+        if pending_email:
+            await asyncio.to_thread(send_activity_verification_email, *pending_email)
+            pending_email = None
     
     return {
         "success": True,
-        **best_result
+        **best_result,
+        "pending_email": pending_email,
+        "activity_added": activity_added
     }
\ No newline at end of file
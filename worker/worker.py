@@ -7,9 +7,18 @@ import pytz
 import schedule
 from sqlalchemy.orm import Session
 
-from models import User, get_db
+from models import Activity, SessionLocal, User, get_db
 from settings import settings
-from services import get_activities_after_date, ensure_fresh_token
+from services import (
+    close_email_connection,
+    bump_leaderboard,
+    close_http_client,
+    ensure_fresh_token,
+    get_activities_after_date,
+    get_athlete_stats,
+    refresh_expiring_tokens,
+    send_activity_verification_email
+)
 from verification import verify_strava_activity
 
 # Configure logging
@@ -24,6 +33,16 @@ logging.basicConfig(
 
 logger = logging.getLogger("kmtb-worker")
 
+# Longest time a user's activities go unchecked while their Strava ride count is unchanged,
+# so rides the count misses (Strava leaves private ones out of its totals) are still found
+MAX_SKIPPED_CHECK_INTERVAL = timedelta(days=1)
+
+# Longest the scheduler sleeps between checks, also bounding how late a run starts after the run hours open
+SCHEDULER_MAX_SLEEP_SECONDS = 300
+
+# Timezone of the run hours, looked up once
+RUN_TIMEZONE = pytz.timezone(getattr(settings, "TZ", "Europe/Warsaw"))
+
 async def process_user_activities(user_id: str, db: Session) -> None:
     """Process activities for a single user"""
     logger.info(f"Processing activities for user {user_id}")
@@ -47,6 +66,19 @@ async def process_user_activities(user_id: str, db: Session) -> None:
         logger.error(f"Failed to get fresh token for user {user_id}: {token_value}")
         return
     
+    # Skip listing (and re-verifying) recent activities when Strava's ride count is unchanged
+    ride_count = None
+    if user.strava_id:
+        stats = await get_athlete_stats(token_value, user.strava_id)
+        ride_count = stats.get("all_ride_totals", {}).get("count")
+        recently_checked = (
+            user.last_activity_check is not None
+            and datetime.now() - user.last_activity_check < MAX_SKIPPED_CHECK_INTERVAL
+        )
+        if ride_count is not None and ride_count == user.strava_ride_count and recently_checked:
+            logger.info(f"No new rides for user {user_id}, skipping activity check")
+            return
+    
     # Determine timestamp to fetch activities after
     after_timestamp = int(time.time())
     
@@ -59,31 +91,83 @@ async def process_user_activities(user_id: str, db: Session) -> None:
         check_time = datetime.now(pytz.UTC) - timedelta(days=30)
         after_timestamp = int(time.mktime(check_time.timetuple()))
     
-    # Update last activity check time
-    user.last_activity_check = datetime.now()
-    db.commit()
+    # The check time and the ride count it saw are saved with its results
+    check_started = datetime.now()
+    
+    # Get recent activities, unless they are unchanged since the last check
+    activities, activities_etag = await get_activities_after_date(
+        token_value, after_timestamp, etag=user.strava_activities_etag
+    )
     
-    # Get recent activities
-    activities = await get_activities_after_date(token_value, after_timestamp)
+    if activities is None:
+        logger.error(f"Failed to get activities for user {user_id}")
+        return
     
     if not activities:
+        user.last_activity_check = check_started
+        if ride_count is not None:
+            user.strava_ride_count = ride_count
+        user.strava_activities_etag = activities_etag
+        db.commit()
         logger.info(f"No new activities found for user {user_id}")
         return
     
     logger.info(f"Found {len(activities)} new activities for user {user_id}")
     
-    # Process each activity
-    for activity in activities:
-        activity_id = activity.get("id")
+    # Look up in one query which of them are already approved; the lookback
+    # overlaps the previous check, so those would only be fetched and verified again
+    approved_ids = {
+        strava_activity_id for (strava_activity_id,) in db.query(Activity.strava_activity_id).filter(
+            Activity.strava_activity_id.in_([str(activity.get("id")) for activity in activities])
+        )
+    }
+    
+    # Process each activity, committing their results in one transaction
+    pending_emails = []
+    added_count = 0
+    all_checked = True
+    try:
+        for activity in activities:
+            activity_id = activity.get("id")
+            if str(activity_id) in approved_ids:
+                logger.info(f"Activity {activity_id} already verified, skipping")
+                continue
+            
+            # Verify activity
+            logger.info(f"Verifying activity {activity_id} for user {user_id}")
+            result = await verify_strava_activity(
+                db, user, str(activity_id), commit=False, access_token=token_value
+            )
+            if result.get("pending_email"):
+                pending_emails.append(result["pending_email"])
+            if result.get("activity_added", False):
+                added_count += 1
+            if result.get("transient", False):
+                all_checked = False
+            
+            if result.get("success", False) and result.get("verified", False):
+                logger.info(f"Activity {activity_id} verified successfully")
+            else:
+                logger.info(f"Activity {activity_id} not verified: {result.get('message')}")
         
-        # Verify activity
-        logger.info(f"Verifying activity {activity_id} for user {user_id}")
-        result = await verify_strava_activity(db, user_id, str(activity_id))
+        # Count the new activities on the leaderboard last, so its row is locked only for the commit
+        if added_count:
+            await bump_leaderboard(db, user_id, added_count)
         
-        if result.get("success", False) and result.get("verified", False):
-            logger.info(f"Activity {activity_id} verified successfully")
-        else:
-            logger.info(f"Activity {activity_id} not verified: {result.get('message')}")
+        # Remember the list and the ride count only once all of its activities were checked; after
+        # a transient failure (token, Strava or source errors) the next check must list them again
+        user.last_activity_check = check_started
+        if ride_count is not None and all_checked:
+            user.strava_ride_count = ride_count
+        user.strava_activities_etag = activities_etag if all_checked else None
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    
+    # Notify only about activities that were actually committed
+    for pending_email in pending_emails:
+        await asyncio.to_thread(send_activity_verification_email, *pending_email)
 
 async def process_all_users(db: Session) -> None:
     """Process activities for all eligible users"""
@@ -98,12 +182,35 @@ async def process_all_users(db: Session) -> None:
     
     logger.info(f"Found {len(users)} eligible users")
     
-    # Process each user
-    for user in users:
-        await process_user_activities(str(user.id), db)
+    # Warm the token cache for just these users, so per-user checks don't each query and refresh their token
+    await refresh_expiring_tokens(db, [user.id for user in users])
+    
+    # Process users concurrently, each with its own session; the shared client keeps
+    # their Strava requests within the rate limit and retries 429 responses
+    semaphore = asyncio.Semaphore(settings.USER_CONCURRENCY)
+    
+    async def process(user_id: str) -> None:
+        async with semaphore:
+            try:
+                with SessionLocal() as user_db:
+                    await process_user_activities(user_id, user_db)
+            except Exception as e:
+                logger.error(f"Error processing user {user_id}: {e}")
+    
+    await asyncio.gather(*(process(str(user.id)) for user in users))
     
     logger.info("Completed activity check for all users")
 
+async def run_job(db: Session) -> None:
+    """Process all users, closing the shared HTTP client before the event loop ends"""
+    try:
+        await process_all_users(db)
+    finally:
+        # Its connections belong to this job's event loop
+        await close_http_client()
+        # Don't hold the SMTP connection open until the next job
+        close_email_connection()
+
 def job() -> None:
     """Main job function to be scheduled"""
     logger.info("Starting scheduled job")
@@ -113,7 +220,7 @@ def job() -> None:
     
     try:
         # Process all users
-        asyncio.run(process_all_users(db))
+        asyncio.run(run_job(db))
     except Exception as e:
         logger.error(f"Error in scheduled job: {e}")
     
@@ -126,8 +233,7 @@ def check_run_time() -> bool:
     Returns:
         bool: True if current time is between 6:00 and 22:00, False otherwise
     """
-    now = datetime.now(pytz.timezone(settings.TZ if hasattr(settings, 'TZ') else 'Europe/Warsaw'))
-    return 6 <= now.hour < 22
+    return 6 <= datetime.now(RUN_TIMEZONE).hour < 22
 
 def main() -> None:
     """Main function to schedule and run jobs"""
@@ -146,7 +252,9 @@ def main() -> None:
         if check_run_time():
             schedule.run_pending()
         
-        time.sleep(60)  # Check every minute
+        # Sleep until the next job is due; an overdue job waits for the run hours
+        idle = schedule.idle_seconds()
+        time.sleep(SCHEDULER_MAX_SLEEP_SECONDS if idle is None or idle <= 0 else min(idle, SCHEDULER_MAX_SLEEP_SECONDS))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file